@@ -6,17 +6,55 @@ from scipy.spatial import distance
 import src.utils as ut
 import src.evaluationsets as es
 import src.MechMappings as mm
+from src.contracting import ContractionInference
+from src.operators import GlobalAlphaOperator
 
 from pgmpy.models import BayesianNetwork as BN
 from pgmpy.factors.discrete import TabularCPD as cpd
 from pgmpy.inference import VariableElimination
+from scipy.sparse.linalg import aslinearoperator
 
 
 
 class SCMMapping():
     def __init__(self,M0,M1):
+        # Derived quantities are cached and invalidated (bumping the version) whenever models or alphas are reassigned
+        self._version = 0
+        self._cache = {}
         self.M0 = M0
         self.M1 = M1
+        
+    @property
+    def M0(self):
+        return self._M0
+    
+    @M0.setter
+    def M0(self,M0):
+        self._M0 = M0
+        self.invalidate_cache()
+        
+    @property
+    def M1(self):
+        return self._M1
+    
+    @M1.setter
+    def M1(self,M1):
+        self._M1 = M1
+        self.invalidate_cache()
+        
+    @property
+    def version(self):
+        return self._version
+        
+    def invalidate_cache(self):
+        # To be called explicitly after modifying models or alphas in place
+        self._version += 1
+        self._cache = {}
+        
+    def _get_cached(self,key,fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
             
             
 class Abstraction(SCMMapping):
@@ -31,7 +69,6 @@ class Abstraction(SCMMapping):
         if not ut.is_list_contained_in_list(R,M0.nodes): raise ValueError("R contains illegal nodes")
         if not ut.is_list_contents_unique(R): raise ValueError("R contains duplicated nodes")
         self.R = R
-        self.nR = len(R)
         
         if not ut.is_list_contained_in_list(list(a.keys()),M0.nodes): raise ValueError("Domain of a contains illegal nodes")
         if not ut.is_list_contained_in_list(list(a.values()),M1.nodes): raise ValueError("Codomain of a contains illegal nodes")
@@ -40,10 +77,45 @@ class Abstraction(SCMMapping):
         
         if not ut.is_list_contained_in_list(list(alphas.keys()),M1.nodes): raise ValueError("Alphas contains functions defined on illegal nodes")
         if not ut.is_surjective(list(alphas.keys()),M1.nodes): raise ValueError("Alphas does not contain all the functions")
+        self.alphas = alphas
+        
+    @property
+    def R(self):
+        return self._R
+    
+    @R.setter
+    def R(self,R):
+        # The orderings and the global alpha depend on R and a, so reassigning them invalidates the cache
+        self._R = R
+        self.nR = len(R)
+        self.invalidate_cache()
+        
+    @property
+    def a(self):
+        return self._a
+    
+    @a.setter
+    def a(self,a):
+        self._a = a
+        self.invalidate_cache()
+        
+    @property
+    def alphas(self):
+        return self._alphas
+    
+    @alphas.setter
+    def alphas(self,alphas):
         self._are_alphas_cardinalities_correct(alphas)
         self._are_alphas_stochastic_and_deterministic(alphas)
-        self.alphas = alphas
+        self._alphas = alphas
+        self.invalidate_cache()
         
+    @property
+    def alpha_vectors(self):
+        # Deterministic alphas are also carried as integer vectors mapping each column to its non-zero row, derived from the
+        # current alphas (after in-place modifications, invalidate_cache() must be called as for any other cached quantity)
+        if not self.deterministic: return None
+        return self._get_cached('alpha_vectors',lambda: {k: ut.map_matrix2vect(v) for k,v in self.alphas.items()})
             
     ### INITIALIZATION VERIFICATION FUNCTIONS    
     def _are_alphas_cardinalities_correct(self,alphas):
@@ -77,7 +149,7 @@ class Abstraction(SCMMapping):
     ### UTILS    
     def copy(self):
         Acopy = Abstraction(self.M0, self.M1,
-                            R=self.R.copy(), a=self.a.copy(), alphas=self.alphas.copy())
+                            R=self.R.copy(), a=self.a.copy(), alphas=self.alphas.copy(), deterministic=self.deterministic)
         return Acopy
     
     def invert_a(self,v):
@@ -86,7 +158,14 @@ class Abstraction(SCMMapping):
     def get_cardinalities_alpha(self,alphakey):
         return ut.get_cardinalities_Falpha(self.a,alphakey,self.M0.get_cardinality(),self.M1.get_cardinality())
             
-    def compute_mechanisms(self,inference,sources,targets,cardinalities):
+    @staticmethod
+    def compute_mechanisms(inference,sources,targets,cardinalities):
+        #Compute P(targets|do(sources)) by contracting the CPD tensors of the model, after pruning barren nodes and nodes disconnected by the intervention
+        if isinstance(inference,ContractionInference):
+            return inference.compute_mechanism(sources,targets,nodes=inference.get_relevant_nodes(sources,targets))
+        
+        #Pruning of barren and irrelevant nodes is performed by VariableElimination.query itself
+        
         #Compute P(targets|do(sources)) as P(targets|sources) in M_do(sources)
         joint_TS = inference.query(targets+sources,show_progress=False)
         marginal_S = inference.query(sources,show_progress=False)
@@ -109,25 +188,56 @@ class Abstraction(SCMMapping):
 
         return cond_TS_val
 
-    def compute_global_alpha(self):
+    def compute_orderings(self):
+        notR, orderingM0, orderingM1 = self._get_cached('orderings',self._compute_orderings)
+        return list(notR), list(orderingM0), list(orderingM1)
+    
+    def _compute_orderings(self):
         orderingM1 = list(self.M1.nodes)
 
+        notR = list(set(self.M0.nodes)-set(self.R))
+        
+        orderingM0 = [self.invert_a(x) for x in orderingM1]
+        orderingM0 = list(itertools.chain.from_iterable(orderingM0))
+        orderingM0 = notR + orderingM0
+        
+        return notR, orderingM0, orderingM1
+    
+    def compute_global_alpha(self,lazy=False):
+        Alpha, orderingM0, orderingM1 = self._get_cached(('global_alpha',lazy),lambda: self._compute_global_alpha(lazy))
+        # Cached arrays are returned as copies, so that modifying a result does not affect later calls (lazy operators are not modifiable)
+        if not lazy: Alpha = Alpha.copy()
+        return Alpha, list(orderingM0), list(orderingM1)
+    
+    def _compute_global_alpha(self,lazy=False):
+        notR, orderingM0, orderingM1 = self.compute_orderings()
+        
+        if lazy:
+            alphas = self.alpha_vectors if self.deterministic else self.alphas
+            Alpha = GlobalAlphaOperator([alphas[x] for x in orderingM1],
+                                        rows=[self.M1.get_cardinality(x) for x in orderingM1],
+                                        n_tiles=np.prod([self.M0.get_cardinality(nr) for nr in notR]))
+            return Alpha, orderingM0, orderingM1
+
         Alpha = self.alphas[orderingM1[0]]
         for i in range(1,len(orderingM1)):
             Alpha = ut.flat_tensor_product(Alpha,self.alphas[orderingM1[i]])
 
-        notR = list(set(self.M0.nodes)-set(self.R))
         for nr in notR:
             Alpha = np.tile(Alpha,(1,self.M0.get_cardinality(nr)))
 
-        orderingM0 = [self.invert_a(x) for x in orderingM1]
-        orderingM0 = list(itertools.chain.from_iterable(orderingM0))
-        orderingM0 = notR + orderingM0
-
         return Alpha, orderingM0, orderingM1 
     
     def compute_joints(self,verbose=False):
-        Alpha, orderingM0, orderingM1 = self.compute_global_alpha()   
+        joint_M0,joint_M1 = self._get_cached('joints',self._compute_joints)
+        joint_M0,joint_M1 = joint_M0.copy(),joint_M1.copy()
+        if verbose: print('M0 joint: {0}'.format(joint_M0))
+        if verbose: print('M1 joint: {0}'.format(joint_M1))
+        
+        return joint_M0,joint_M1
+    
+    def _compute_joints(self):
+        _, orderingM0, orderingM1 = self.compute_orderings()
     
         inferM0 = VariableElimination(self.M0)
         joint_M0 = inferM0.query(orderingM0,show_progress=False)
@@ -136,7 +246,6 @@ class Abstraction(SCMMapping):
         new_indexes = [(orderingM0).index(i) for i in joint_M0.variables]
         joint_M0 = np.moveaxis(joint_M0.values, old_indexes, new_indexes)
         joint_M0 = joint_M0.reshape((np.prod(joint_M0.shape),1))
-        if verbose: print('M0 joint: {0}'.format(joint_M0))
         
         if (len(self.M1.nodes)==1 and self.M1.get_cardinality(orderingM1[0])==1):
             joint_M1 = self.M1.get_cpds(orderingM1[0])
@@ -148,26 +257,45 @@ class Abstraction(SCMMapping):
         new_indexes = [(orderingM1).index(i) for i in joint_M1.variables]
         joint_M1 = np.moveaxis(joint_M1.values, old_indexes, new_indexes)
         joint_M1 = joint_M1.reshape((np.prod(joint_M1.shape),1))
-        if verbose: print('M1 joint: {0}'.format(joint_M1))
         
         return joint_M0,joint_M1
     
-    def compute_inv_alpha(self,invalpha_algorithm=None, verbose=False):
+    def compute_inv_alpha(self,invalpha_algorithm=None, verbose=False, lazy=False):
+        invalpha = self._get_cached(('inv_alpha',invalpha_algorithm,lazy),lambda: self._compute_inv_alpha(invalpha_algorithm,lazy))
+        if not lazy: invalpha = invalpha.copy()
+        if verbose:
+            # Lazy inverses are not materialized, so only their shape is reported
+            if lazy: print('Alpha^-1: lazy operator of shape {0}'.format(invalpha.shape))
+            else: print('Alpha^-1: {0}'.format(invalpha))
+        
+        return invalpha
+    
+    def _compute_inv_alpha(self,invalpha_algorithm=None, lazy=False):
+        if lazy:
+            Alpha, orderingM0, orderingM1 = self.compute_global_alpha(lazy=True)
+            if invalpha_algorithm is None or invalpha_algorithm is ut.invert_matrix_max_entropy:
+                invalpha = Alpha.invert_max_entropy()
+            elif invalpha_algorithm is ut.invert_matrix_pinv:
+                invalpha = Alpha.invert_pinv()
+            else:
+                # Custom algorithms have no lazy equivalent and require the dense global alpha
+                invalpha = aslinearoperator(invalpha_algorithm(self.compute_global_alpha()[0]))
+            
+            return invalpha
+        
         Alpha, orderingM0, orderingM1 = self.compute_global_alpha()
                
         if invalpha_algorithm is None:
             invalpha = ut.invert_matrix_max_entropy(Alpha)
         else:
             invalpha = invalpha_algorithm(Alpha)
-        if verbose: print('Alpha^-1: {0}'.format(invalpha))
             
         return invalpha
     
     def compute_inverse_joint_M1(self, invalpha_algorithm=None, verbose=False):
-        Alpha, orderingM0, orderingM1 = self.compute_global_alpha()
         joint_M0,joint_M1 = self.compute_joints(verbose=verbose)
-        invalpha = self.compute_inv_alpha(invalpha_algorithm=invalpha_algorithm, verbose=verbose)
-        inverse_joint_M1 = np.dot(invalpha,joint_M1)
+        invalpha = self.compute_inv_alpha(invalpha_algorithm=invalpha_algorithm, verbose=verbose, lazy=True)
+        inverse_joint_M1 = invalpha.matmat(joint_M1)
             
         if verbose: print('Transformed M1 joint: {0}'.format(inverse_joint_M1))
             
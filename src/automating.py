@@ -4,6 +4,9 @@ import torch
 import itertools
 from pgmpy.inference import VariableElimination
 
+import src.utils as ut
+from src.contracting import contract_factors
+
 
 def get_alpha_dims(M0, M1, a):
     M0_card = M0.get_cardinality()
@@ -42,11 +45,24 @@ def get_all_evidence_values(evidence_cards):
 
 
 def construct_mechanism(infer, variables, variable_dimension,all_evidence_values):
-    mechanism = np.zeros((variable_dimension, len(all_evidence_values)), dtype=np.float32)
-    for i in range(len(all_evidence_values)):
-        tmp_inference = infer.query(variables, evidence=all_evidence_values[i], show_progress=False)
-        flatten_inf = np.array(tmp_inference.values, dtype=np.float32).flatten()
-        mechanism[:, i] = flatten_inf
+    # The whole mechanism comes from a single contraction of the CPDs over variables and evidence, normalized over the variables,
+    # instead of one query per evidence value. As in the queries, CPDs defined only on evidence variables are left out: they are
+    # constant for each evidence value, and dropping them keeps a distribution for evidence values of probability zero
+    evidences = list(all_evidence_values[0].keys())
+    model = infer.model
+    relevant = model.get_ancestral_graph(list(variables)+evidences).nodes()
+    factors = [(list(cpd.variables), np.asarray(cpd.values,dtype=np.float64)) for cpd in model.get_cpds()
+               if cpd.variable in relevant and not set(cpd.variables) <= set(evidences)]
+    scope = set(v for f in factors for v in f[0])
+    factors += [([e], np.ones(model.get_cardinality(e))) for e in evidences if e not in scope]
+    _,values = contract_factors(factors, list(variables)+evidences)
+    
+    # Columns are gathered in the order of all_evidence_values
+    values = values.reshape((variable_dimension,)+values.shape[len(variables):])
+    columns = values[(slice(None),)+tuple(np.array([ev[e] for ev in all_evidence_values],dtype=int) for e in evidences)]
+    columns = columns.reshape((variable_dimension,len(all_evidence_values)))
+    with np.errstate(divide='ignore',invalid='ignore'):
+        mechanism = (columns / np.sum(columns,axis=0,keepdims=True)).astype(np.float32)
     return torch.from_numpy(mechanism)
 
 
@@ -121,4 +137,96 @@ def generate_data(M0_diagrams, M0, n_samples, r_seed):
             torch_data_list.append(torch.from_numpy(one_hot_data))
             data_index[str(diagram)] = len(torch_data_list)-1
             
-    return torch_data_list, data_index
\ No newline at end of file
+    return torch_data_list, data_index
+
+class RelaxedAbstractionError(torch.nn.Module):
+    # Abstraction error over J as a differentiable function of the alphas, each one relaxed into a column-stochastic matrix
+    # softmax(logits/temperature) that approaches a deterministic map as the temperature goes to zero
+    def __init__(self, J, mechanisms, alpha_dims, metric='jsd', reduction='cumulative', generator=None):
+        super().__init__()
+        if metric not in TORCH_METRICS: raise ValueError("Unknown metric {0}".format(metric))
+        if reduction not in ('overall','cumulative'): raise ValueError("Unknown reduction {0}".format(reduction))
+        self.J = [[list(S),list(T)] for S,T in J]
+        self.metric = metric
+        self.reduction = reduction
+        self.alpha_labels = list(alpha_dims.keys())
+        self.logits = torch.nn.ParameterDict({X: torch.nn.Parameter(0.01*torch.randn(alpha_dims[X],dtype=torch.float64,generator=generator))
+                                              for X in self.alpha_labels})
+        # The mechanisms do not depend on the alphas and are not trained
+        for k,(M0_mech,M1_mech) in enumerate(mechanisms):
+            self.register_buffer('M0_mech_{0}'.format(k),torch.as_tensor(np.asarray(M0_mech),dtype=torch.float64))
+            self.register_buffer('M1_mech_{0}'.format(k),torch.as_tensor(np.asarray(M1_mech),dtype=torch.float64))
+
+    @classmethod
+    def from_plan(cls, plan, M0, M1, a, **kwargs):
+        return cls(plan.J, plan.mechanisms, get_alpha_dims(M0,M1,a), **kwargs)
+
+    def get_relaxed_alphas(self, temperature=1.0):
+        return {X: torch.softmax(self.logits[X]/temperature,dim=0) for X in self.alpha_labels}
+
+    def get_alphas(self):
+        # Snap every relaxed alpha onto the closest deterministic surjection
+        return {X: ut.map_vect2matrix(snap_to_surjection(self.logits[X].detach().numpy()),self.logits[X].shape[0]) for X in self.alpha_labels}
+
+    def surjectivity_penalty(self, temperature=1.0):
+        # Every value of the codomain should receive at least the mass of one element of the domain
+        return sum(torch.sum(torch.relu(1.0-torch.sum(alpha,dim=1))) for alpha in self.get_relaxed_alphas(temperature).values())
+
+    def forward(self, temperature=1.0):
+        alphas = self.get_relaxed_alphas(temperature)
+        errors = []
+        for k,(S,T) in enumerate(self.J):
+            M0_mech = getattr(self,'M0_mech_{0}'.format(k)); M1_mech = getattr(self,'M1_mech_{0}'.format(k))
+            lowerpath = torch_dot_kron(M1_mech,[alphas[X] for X in S])
+            upperpath = torch_kron_dot([alphas[X] for X in T],M0_mech)
+            errors.append(torch.max(TORCH_METRICS[self.metric](lowerpath,upperpath)))
+        errors = torch.stack(errors)
+        if self.reduction == 'overall': return torch.max(errors)
+        return torch.sum(errors)
+
+
+def torch_kron_dot(l, M):
+    # Torch equivalent of utils.kron_dot (mode-n products, without materializing the tensor product)
+    T = M.reshape([x.shape[1] for x in l]+[M.shape[1]])
+    for i in range(len(l)):
+        T = torch.movedim(torch.tensordot(l[i],T,dims=([1],[i])),0,i)
+    return T.reshape((int(np.prod([x.shape[0] for x in l])),M.shape[1]))
+
+
+def torch_dot_kron(M, l):
+    # Torch equivalent of utils.dot_kron
+    T = M.reshape([M.shape[0]]+[x.shape[0] for x in l])
+    for i in range(len(l)):
+        T = torch.movedim(torch.tensordot(T,l[i],dims=([i+1],[0])),-1,i+1)
+    return T.reshape((M.shape[0],int(np.prod([x.shape[1] for x in l]))))
+
+
+def torch_jensenshannon(P, Q, eps=1e-12):
+    P = P / torch.sum(P,dim=0,keepdim=True); Q = Q / torch.sum(Q,dim=0,keepdim=True)
+    M = (P+Q) / 2.0
+    js = torch.sum(P*(torch.log(P+eps)-torch.log(M+eps)),dim=0) + torch.sum(Q*(torch.log(Q+eps)-torch.log(M+eps)),dim=0)
+    # Clamped away from zero, where the square root is not differentiable
+    return torch.sqrt(torch.clamp(js/2.0,min=eps))
+
+
+def torch_total_variation(P, Q):
+    P = P / torch.sum(P,dim=0,keepdim=True); Q = Q / torch.sum(Q,dim=0,keepdim=True)
+    return torch.sum(torch.abs(P-Q),dim=0) / 2.0
+
+
+TORCH_METRICS = {'jsd': torch_jensenshannon,
+                 'tv': torch_total_variation}
+
+
+def snap_to_surjection(logits):
+    # Assign every element of the domain to its most likely value, then repair the values left without preimage by moving,
+    # among the elements whose value has other preimages, the one that most prefers the missing value
+    codom,dom = logits.shape
+    if dom < codom: raise ValueError("No surjection exists from a domain of size {0} to a codomain of size {1}".format(dom,codom))
+    v = np.argmax(logits,axis=0)
+    for missing in np.where(np.bincount(v,minlength=codom)==0)[0]:
+        counts = np.bincount(v,minlength=codom)
+        candidates = np.where(counts[v]>1)[0]
+        best = candidates[np.argmax(logits[missing,candidates]-logits[v[candidates],candidates])]
+        v[best] = missing
+    return v
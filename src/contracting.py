@@ -0,0 +1,133 @@
+import numpy as np
+
+
+class ContractionInference():
+    """
+    Inference engine computing interventional mechanisms P(targets|do(sources)) directly from the CPD tensors of a model.
+
+    The intervention do(sources) is implemented by dropping the CPDs of the intervened nodes (cutting their incoming edges)
+    and leaving their variables free; the remaining CPD tensors are contracted by eliminating one hidden variable at a time.
+    Since the intervened nodes become roots, the result is already the conditional P(targets|do(sources)).
+    """
+    def __init__(self,model):
+        factors = {}
+        for cpd in model.get_cpds():
+            factors[cpd.variable] = (list(cpd.variables), np.asarray(cpd.values,dtype=np.float64))
+        self._set_factors(factors,dict(model.get_cardinality()),list(model.nodes()))
+        
+    @classmethod
+    def from_factors(cls,factors,cardinalities,nodes):
+        """
+        Build the inference engine directly from the CPD tensors (e.g., arrays in shared memory), without a pgmpy model.
+
+        Args:
+            factors: dictionary mapping each node to a tuple (list of variables [node]+evidence, numpy array with one axis per variable)
+            cardinalities: dictionary of node cardinalities
+            nodes: list of nodes of the model
+        """
+        inference = cls.__new__(cls)
+        inference._set_factors(factors,cardinalities,nodes)
+        return inference
+    
+    def _set_factors(self,factors,cardinalities,nodes):
+        self.factors = factors
+        self.cardinalities = cardinalities
+        self.nodes = nodes
+        self.parents = {node: factor[0][1:] for node,factor in self.factors.items()}
+        
+    def get_relevant_nodes(self,sources,targets):
+        """
+        Compute the nodes relevant to P(targets|do(sources)), that is the ancestors of targets and sources in the graph mutilated by do(sources).
+        
+        All the other nodes are either barren (their CPDs sum out to one) or disconnected from the targets by the intervention.
+        """
+        relevant = set(sources)
+        stack = [t for t in targets if t not in relevant]
+        while stack:
+            node = stack.pop()
+            if node in relevant: continue
+            relevant.add(node)
+            # The intervention cuts the incoming edges of the sources, which are never expanded
+            stack.extend(p for p in self.parents.get(node,[]) if p not in relevant)
+        return [n for n in self.nodes if n in relevant]
+
+    def compute_mechanism(self,sources,targets,nodes=None):
+        """
+        Compute the mechanism P(targets|do(sources)) as a matrix.
+
+        Args:
+            sources: list of intervened nodes
+            targets: list of target nodes (disjoint from sources)
+            nodes: list of nodes whose CPDs take part in the contraction (default: all the nodes in the model)
+
+        Returns:
+            2D numpy array of shape [targets x sources], with rows and columns ordered as the joint values of targets and sources
+        """
+        tensor = self.compute_mechanism_tensor(sources,targets,nodes=nodes)
+        target_card = int(np.prod([self.cardinalities[t] for t in targets]))
+        source_card = int(np.prod([self.cardinalities[s] for s in sources]))
+        return tensor.reshape(target_card,source_card)
+
+    def compute_mechanism_tensor(self,sources,targets,nodes=None):
+        """
+        Compute the mechanism P(targets|do(sources)) as a tensor with one axis per variable in targets+sources.
+        """
+        if nodes is None: nodes = self.nodes
+        factors = [self.factors[n] for n in nodes if n not in sources]
+
+        # Variables appearing only in the interventions are added as constant factors
+        variables = _union_variables(factors)
+        for s in sources:
+            if s not in variables: factors.append(([s], np.ones(self.cardinalities[s])))
+
+        hidden = [v for v in variables if v not in sources and v not in targets]
+        while hidden:
+            var = self._select_variable_to_eliminate(factors,hidden)
+            involved = [f for f in factors if var in f[0]]
+            factors = [f for f in factors if var not in f[0]]
+            keep = [v for v in _union_variables(involved) if v != var]
+            factors.append(contract_factors(involved,keep))
+            hidden.remove(var)
+
+        _,tensor = contract_factors(factors,targets+sources)
+        return tensor
+
+    def _select_variable_to_eliminate(self,factors,hidden):
+        # Greedy min-weight heuristic: eliminate the variable producing the smallest intermediate factor
+        best_var = None; best_weight = None
+        for var in hidden:
+            scope = _union_variables([f for f in factors if var in f[0]])
+            weight = np.prod([self.cardinalities[v] for v in scope],dtype=np.float64)
+            if best_weight is None or weight < best_weight:
+                best_var = var; best_weight = weight
+        return best_var
+
+
+def _union_variables(factors):
+    variables = []
+    for f in factors:
+        for v in f[0]:
+            if v not in variables: variables.append(v)
+    return variables
+
+def contract_factors(factors,keep):
+    """
+    Multiply a list of factors and sum out all the variables not in keep.
+
+    Args:
+        factors: list of factors, each factor being a tuple (list of variables, numpy array with one axis per variable)
+        keep: list of variables to keep, in the desired order of the axes of the output
+
+    Returns:
+        Factor (keep, numpy array) obtained by multiplication and marginalization
+    """
+    variables = _union_variables(factors)
+    indexes = {v:i for i,v in enumerate(variables)}
+
+    operands = []
+    for f in factors:
+        operands.append(f[1])
+        operands.append([indexes[v] for v in f[0]])
+    operands.append([indexes[v] for v in keep])
+
+    return list(keep), np.einsum(*operands,optimize=True)
@@ -1,5 +1,12 @@
-
+import os
 import numpy as np
+import itertools
+import functools
+import pickle
+import hashlib
+import collections
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 from scipy.spatial import distance
 from pgmpy.inference import VariableElimination
@@ -7,6 +14,10 @@ from pgmpy.inference import VariableElimination
 import src.utils as ut
 import src.evaluationsets as es
 import src.MechMappings as mm
+import src.metrics as metrics
+import src.parallel as parallel
+from src.contracting import ContractionInference
+from src.SCMMappings_1_1 import Abstraction
 
 
 class SCMMappingEvaluator():
@@ -17,92 +28,615 @@ class AbstractionEvaluator(SCMMappingEvaluator):
     def __init__(self,A):
         super().__init__(A)
             
+    def _iter_mechanisms(self, J, backend='pgmpy', verbose=False):
+        if backend == 'einsum':
+            # The contraction engines handle the interventions themselves and are shared by all the pairs
+            engines = (ContractionInference(self.A.M0), ContractionInference(self.A.M1))
+        elif backend == 'pgmpy':
+            engines = None
+        else:
+            raise ValueError("Unknown inference backend {0}".format(backend))
+
+        # Mechanisms are yielded as soon as they are computed, together with the index of their pair in J, so that callers can
+        # consume them one at a time (pairs of a list are grouped by sources, and therefore not computed in the order of J)
+        for group in _group_pairs(J):
+            inferM0,inferM1 = engines if engines is not None else self._get_group_engines(group[0][1][0])
+            mechanisms = _iter_group_mechanisms([pair for _,pair in group],inferM0,inferM1,self.A.invert_a,self.A.compute_mechanisms,
+                                                self.A.M0.get_cardinality(),self.A.M1.get_cardinality(),verbose=verbose)
+            for (k,_),res in zip(group,mechanisms):
+                yield k,res
+
+    def _get_group_engines(self, M1_sources):
+        # Perform interventions in the abstracted and in the base model and setup the inference engines, once for all the pairs in the group
+        inferM1 = VariableElimination(self.A.M1.do(M1_sources))
+        inferM0 = VariableElimination(self.A.M0.do(self.A.invert_a(M1_sources)))
+        return inferM0,inferM1
+
+
+def _group_pairs(J):
+    """
+    Group the pairs of J sharing the same sources, so that the intervened models can be reused; each group is a list of tuples (index in J, pair).
+    
+    Lists are grouped globally, while streamed pairs are grouped by consecutive sources (as generated by the power set).
+    """
+    if isinstance(J,(list,tuple)):
+        groups = {}
+        for k,pair in enumerate(J):
+            groups.setdefault(tuple(pair[0]),[]).append((k,pair))
+        yield from groups.values()
+    else:
+        for _,group in itertools.groupby(enumerate(J),key=lambda x: tuple(x[1][0])):
+            yield list(group)
+
+def _iter_group_mechanisms(pairs,inferM0,inferM1,invert_a,compute_mechanisms,cardinalities_M0,cardinalities_M1,verbose=False):
+    # Get the common sources in the abstracted and in the base model
+    M1_sources = pairs[0][0]
+    M0_sources = invert_a(M1_sources)
+    
+    # Mechanisms are inferred only for the maximal target sets; every other target set is obtained by marginalization
+    maximal_sets = _get_maximal_sets([pair[1] for pair in pairs])
+    maximal_targets = [_get_maximal_superset(pair[1],maximal_sets) for pair in pairs]
+    remaining_uses = {}
+    for M1_max_targets in maximal_targets:
+        remaining_uses[tuple(M1_max_targets)] = remaining_uses.get(tuple(M1_max_targets),0) + 1
+    maximal_mechanisms = {}
+
+    for pair,M1_max_targets in zip(pairs,maximal_targets):
+        # Get nodes in the abstracted model
+        M1_targets = pair[1]
+        if verbose: print('\nM1: {0} -> {1}'.format(M1_sources,M1_targets))
+
+        # Get nodes in the base model
+        M0_targets = invert_a(M1_targets)
+        if verbose: print('M0: {0} -> {1}'.format(M0_sources,M0_targets))
+        
+        key = tuple(M1_max_targets)
+        M0_max_targets = invert_a(M1_max_targets)
+        if key not in maximal_mechanisms:
+            # Compute the high-level and the low-level mechanisms on the maximal target sets
+            maximal_mechanisms[key] = (compute_mechanisms(inferM0,M0_sources,M0_max_targets,cardinalities_M0),
+                                       compute_mechanisms(inferM1,M1_sources,M1_max_targets,cardinalities_M1))
+        M0_max_cond_TS_val,M1_max_cond_TS_val = maximal_mechanisms[key]
+        remaining_uses[key] -= 1
+        if remaining_uses[key] == 0: del maximal_mechanisms[key]
+
+        # Compute the high-level mechanisms
+        M1_cond_TS_val = ut.marginalize_mechanism(M1_max_cond_TS_val,M1_max_targets,M1_targets,cardinalities_M1)
+        if verbose: print('M1 mechanism shape: {}'.format(M1_cond_TS_val.shape))
+
+        # Compute the low-level mechanisms
+        M0_cond_TS_val = ut.marginalize_mechanism(M0_max_cond_TS_val,M0_max_targets,M0_targets,cardinalities_M0)
+        if verbose: print('M0 mechanism shape: {}'.format(M0_cond_TS_val.shape))
+
+        yield M1_sources,M1_targets,M0_cond_TS_val,M1_cond_TS_val
+
+
 class AbstractionErrorEvaluator(AbstractionEvaluator):
     def __init__(self,A):
         super().__init__(A)
-        
-    def evaluate_abstraction_errors(self, metric=None, J=None,J_algorithm=None, verbose=False, debug=False):
+        # Last error observed for each pair (sources,targets), used to try failing pairs first in bounded evaluations
+        self.error_history = {}
+
+    def _get_J(self, J=None, J_algorithm=None, verbose=False):
         if J is None and J_algorithm is None:
-            J = es.get_sets_in_M1_with_directed_path_in_M1_or_M0(self.A.M0,self.A.M1,self.A.a,verbose=verbose)
+            # The default evaluation set is streamed, so that evaluation starts immediately and runs in constant memory in |J|
+            if verbose: print('Evaluating up to {0} pairs of sets'.format(es.count_disjoint_sets(self.A.M1)))
+            J = es.iter_sets_in_M1_with_directed_path_in_M1_or_M0(self.A.M0,self.A.M1,self.A.a,verbose=verbose)
         elif J is None:
             J = J_algorithm(self)
-            
-        if metric is None:
-            metric = distance.jensenshannon
-        
-        abstraction_errors = []
+        return J
 
-        for pair in J:
-            # Get nodes in the abstracted model
-            M1_sources = pair[0]
-            M1_targets = pair[1]
-            if verbose: print('\nM1: {0} -> {1}'.format(M1_sources,M1_targets))
+    def _get_alphas(self, alphas=None):
+        # Alphas passed explicitly are scored without touching the abstraction, so that evaluations may run concurrently
+        if alphas is not None: return alphas
+        # Deterministic alphas are applied in their integer vector form
+        if self.A.deterministic: return self.A.alpha_vectors
+        return self.A.alphas
 
-            # Get nodes in the base model
-            M0_sources = self.A.invert_a(M1_sources)
-            M0_targets = self.A.invert_a(M1_targets)
-            if verbose: print('M0: {0} -> {1}'.format(M0_sources,M0_targets))
+    def _get_backend(self, backend=None, n_jobs=1):
+        # Parallel evaluation is only available with the einsum backend, which is then the default
+        if backend is None: return 'pgmpy' if n_jobs == 1 else 'einsum'
+        return backend
 
-            # Perform interventions in the abstracted model and setup the inference engine
-            M1do = self.A.M1.do(M1_sources)
-            inferM1 = VariableElimination(M1do)
+    def compile_plan(self, J=None,J_algorithm=None, backend='pgmpy', memo_size=2**16, verbose=False):
+        J = self._get_J(J=J,J_algorithm=J_algorithm,verbose=verbose)
+        return AbstractionErrorPlan(self,J,backend=backend,memo_size=memo_size,verbose=verbose)
+    
+    def evaluate_batch(self, alphas, metric=None, J=None,J_algorithm=None, backend='pgmpy', reduction='overall', verbose=False):
+        # See AbstractionErrorPlan.score_batch; the mechanisms are computed once for the whole batch
+        return self.compile_plan(J=J,J_algorithm=J_algorithm,backend=backend,memo_size=0,verbose=verbose).score_batch(alphas,metric=metric,reduction=reduction)
 
-            # Perform interventions in the base model and setup the inference engine
-            M0do = self.A.M0.do(M0_sources)
-            inferM0 = VariableElimination(M0do)
+    def evaluate_abstraction_errors(self, metric=None, J=None,J_algorithm=None, backend=None, n_jobs=1, alphas=None, verbose=False, debug=False):
+        J = self._get_J(J=J,J_algorithm=J_algorithm,verbose=verbose)
 
-            # Compute the high-level mechanisms
-            M1_cond_TS_val = self.A.compute_mechanisms(inferM1,M1_sources,M1_targets,self.A.M1.get_cardinality())
-            if verbose: print('M1 mechanism shape: {}'.format(M1_cond_TS_val.shape))
+        if metric is None:
+            metric = distance.jensenshannon
 
-            # Compute the low-level mechanisms
-            M0_cond_TS_val = self.A.compute_mechanisms(inferM0,M0_sources,M0_targets,self.A.M0.get_cardinality())
-            if verbose: print('M0 mechanism shape: {}'.format(M0_cond_TS_val.shape))
+        alphas = self._get_alphas(alphas)
+        cardinalities = self.A.M1.get_cardinality()
+        backend = self._get_backend(backend,n_jobs)
+        
+        # Per-pair verbose and debug output, and metrics that cannot be sent to worker processes (e.g., lambdas), are only
+        # supported by the serial evaluation, which is used in these cases
+        if n_jobs != 1 and not (verbose or debug) and _is_picklable(metric):
+            abstraction_errors = self._evaluate_abstraction_errors_in_parallel(J,alphas,metric=metric,backend=backend,n_jobs=n_jobs)
+        else:
+            # Every error is computed as soon as its mechanisms are available, and placed at the index of its pair in J
+            errors = {}
+            for k,(M1_sources,M1_targets,M0_cond_TS_val,M1_cond_TS_val) in self._iter_mechanisms(J,backend=backend,verbose=verbose):
+                errors[k] = compute_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,alphas,
+                                                      metric=metric,cardinalities=cardinalities,verbose=verbose,debug=debug)
+                self.error_history[(tuple(M1_sources),tuple(M1_targets))] = errors[k]
+            abstraction_errors = [errors[k] for k in range(len(errors))]
 
-            # Compute the alpha for sources
-            alphas_S = [self.A.alphas[i] for i in M1_sources]
-            alpha_S = ut.tensorize_list(None,alphas_S)
-            if verbose: print('Alpha_s shape: {}'.format(alpha_S.shape))
+        # Select the greatest distance over all pairs considered
+        if verbose: print('\n\nOVERALL ABSTRACTION ERROR: {0}'.format(np.max(abstraction_errors)))
+            
+        return abstraction_errors
+    
+    def _evaluate_abstraction_errors_in_parallel(self, J, alphas, metric=None, backend='einsum', n_jobs=-1):
+        # Workers read the CPD tensors and the alphas from shared memory and rebuild their own contraction engines
+        if backend != 'einsum': raise ValueError("Parallel evaluation requires the einsum backend")
+        if n_jobs is None or n_jobs < 0: n_jobs = os.cpu_count()
+        
+        arrays = {}; models = {}
+        for name,M in [('M0',self.A.M0),('M1',self.A.M1)]:
+            inference = ContractionInference(M)
+            for node,(variables,values) in inference.factors.items():
+                arrays[(name,node)] = values
+            models[name] = ({node: variables for node,(variables,_) in inference.factors.items()}, inference.cardinalities, inference.nodes)
+        for k,alpha in alphas.items():
+            arrays[('alpha',k)] = alpha
+        
+        shm,specs = parallel.share_arrays(arrays)
+        try:
+            errors = {}; pairs = {}
+            with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_worker,
+                                     initargs=(shm.name,specs,models,self.A.a,list(alphas.keys()),metric)) as executor:
+                futures = []
+                for group in _group_pairs(J):
+                    pairs.update(group)
+                    futures.append(executor.submit(_evaluate_group_in_worker,group))
+                for future in futures:
+                    errors.update(future.result())
+        finally:
+            shm.close()
+            shm.unlink()
+        
+        for k,(M1_sources,M1_targets) in pairs.items():
+            self.error_history[(tuple(M1_sources),tuple(M1_targets))] = errors[k]
+        
+        # Results are returned in the order of J
+        return [errors[k] for k in range(len(errors))]
+    
+    def _order_pairs(self, J):
+        # Source groups are kept contiguous (to reuse the intervened models) and sorted so that pairs that failed in previous
+        # evaluations come first, followed by unseen pairs from the cheapest, and finally by pairs previously found exact
+        groups = [[pair for _,pair in group] for group in _group_pairs(J)]
+        cardinalities = self.A.M1.get_cardinality()
+        
+        def get_priority(group):
+            history = [self.error_history[(tuple(S),tuple(T))] for S,T in group if (tuple(S),tuple(T)) in self.error_history]
+            history = [h for h in history if not np.isnan(h)]
+            if len(history)>0 and np.max(history)>0: return (0,-np.max(history))
+            cost = np.prod([cardinalities[n] for n in set(group[0][0]).union(*[T for _,T in group])],dtype=np.float64)
+            if len(history)==0: return (1,cost)
+            return (2,cost)
+        
+        groups = sorted(groups,key=get_priority)
+        return [pair for group in groups 
+                for pair in sorted(group,key=lambda p: -np.nan_to_num(self.error_history.get((tuple(p[0]),tuple(p[1])),0)))]
+    
+    def _evaluate_bounded_abstraction_error(self, stop_above, metric=None, J=None,J_algorithm=None, backend=None, alphas=None, verbose=False):
+        J = self._order_pairs(self._get_J(J=J,J_algorithm=J_algorithm,verbose=verbose))
+        backend = self._get_backend(backend)
 
-            # Compute the alpha for targers
-            alphas_T = [self.A.alphas[i] for i in M1_targets]
-            alpha_T = ut.tensorize_list(None,alphas_T)
-            if verbose: print('Alpha_t shape: {}'.format(alpha_T.shape))
+        if metric is None:
+            metric = distance.jensenshannon
 
-            # Evaluate the paths on the diagram
-            lowerpath = np.dot(M1_cond_TS_val,alpha_S)
-            upperpath = np.dot(alpha_T,M0_cond_TS_val)
+        alphas = self._get_alphas(alphas)
+        cardinalities = self.A.M1.get_cardinality()
+        overall_error = 0
+        
+        # Pairs are streamed, so that no mechanism is computed after the bound is exceeded
+        for _,(M1_sources,M1_targets,M0_cond_TS_val,M1_cond_TS_val) in self._iter_mechanisms(iter(J),backend=backend,verbose=verbose):
+            error = compute_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,alphas,
+                                              metric=metric,cardinalities=cardinalities,verbose=verbose)
+            self.error_history[(tuple(M1_sources),tuple(M1_targets))] = error
+            if not np.isnan(error): overall_error = max(overall_error,error)
+            if overall_error > stop_above:
+                if verbose: print('\n\nABSTRACTION ERROR ABOVE {0}: {1}'.format(stop_above,overall_error))
+                break
+            
+        return overall_error
+    
+    def evaluate_overall_abstraction_error(self, metric=None, J=None,J_algorithm=None, backend=None, n_jobs=1, stop_above=None, alphas=None, verbose=False):
+        # With stop_above, evaluation stops as soon as a pair has an error greater than stop_above, and such error is returned
+        # (a lower bound of the overall error, sufficient to decide whether the overall error exceeds stop_above).
+        # Early stopping is only available in serial evaluation: with n_jobs != 1, stop_above is ignored and all the pairs are
+        # evaluated in parallel, returning the exact overall error (also a valid answer for the same decision)
+        if stop_above is not None and n_jobs == 1:
+            return self._evaluate_bounded_abstraction_error(stop_above,metric=metric,J=J,J_algorithm=J_algorithm,backend=backend,alphas=alphas,verbose=verbose)
+        
+        errors = np.array(self.evaluate_abstraction_errors(metric=metric,J=J,J_algorithm=J_algorithm,backend=backend,n_jobs=n_jobs,alphas=alphas,verbose=verbose))
+        errors[np.argwhere(np.isnan(errors))] = 0
+        return np.max(errors)
+    
+    def evaluate_cumulative_abstraction_errors(self, metric=None, J=None,J_algorithm=None, backend=None, n_jobs=1, alphas=None, verbose=False):
+        errors = np.array(self.evaluate_abstraction_errors(metric=metric,J=J,J_algorithm=J_algorithm,backend=backend,n_jobs=n_jobs,alphas=alphas,verbose=verbose))
+        errors[np.argwhere(np.isnan(errors))] = 0
+        return np.sum(errors)
+    
+    def is_exact(self, metric=None,J=None,J_algorithm=None,backend=None,n_jobs=1,alphas=None,verbose=False, rtol=1e-05, atol=1e-08):
+        # np.isclose(0,e) holds iff e <= atol + rtol*e, i.e. e <= atol/(1-rtol), so evaluation can stop at the first pair above this bound
+        # (in serial evaluation only: with n_jobs != 1 all the pairs are evaluated, see evaluate_overall_abstraction_error)
+        bound = atol/(1-rtol) if rtol < 1 else np.inf
+        error = self.evaluate_overall_abstraction_error(metric=metric,J=J,J_algorithm=J_algorithm,backend=backend,n_jobs=n_jobs,stop_above=bound,alphas=alphas,verbose=verbose)
+        return np.isclose(0,error,rtol=rtol,atol=atol)
+        
+class AbstractionErrorPlan():
+    """
+    Compiled evaluation of the abstraction error for fixed models M0 and M1, map a and evaluation set J.
 
-            # Compute abstraction error for every possible intervention
-            distances = []
-            if debug: print('{0} \n\n {1}'.format(lowerpath,upperpath))
-            for c in range(lowerpath.shape[1]):
-                distances.append( metric(lowerpath[:,c],upperpath[:,c]) )
-            if verbose: print('All JS distances: {0}'.format(distances))
+    The low- and high-level mechanisms do not depend on the alphas, so they are computed once at compilation time;
+    scoring a new set of alphas only requires the alpha products and the distance computation.
+    
+    Since the error of a pair (S,T) depends only on the alphas of the nodes in S and T, pair errors are memoized in an LRU table
+    keyed by the pair and by a hash of these alphas (memo_size=0 disables memoization).
+    
+    Scoring never modifies the abstraction and the memo is guarded by a lock, so a plan can be shared by several threads.
+    """
+    def __init__(self,Aev,J,backend='pgmpy',memo_size=2**16,verbose=False):
+        self.A = Aev.A
+        self.cardinalities = dict(self.A.M1.get_cardinality())
+        results = {}
+        for k,(M1_sources,M1_targets,M0_cond_TS_val,M1_cond_TS_val) in Aev._iter_mechanisms(J,backend=backend,verbose=verbose):
+            results[k] = ([M1_sources,M1_targets],(M0_cond_TS_val,M1_cond_TS_val))
+        self.J = [results[k][0] for k in range(len(results))]
+        self.mechanisms = [results[k][1] for k in range(len(results))]
+        # Last error observed for each pair, used to try failing pairs first in bounded scoring (cheapest pairs first initially)
+        self.error_history = np.zeros(len(self.J))
+        self.costs = np.array([M0_cond_TS_val.size for M0_cond_TS_val,_ in self.mechanisms])
+        
+        self.memo_size = memo_size
+        self.clear_memo()
 
-            # Select the greatest distance over all interventions
-            if verbose: print('\nAbstraction error: {0}'.format(np.max(distances)))
-            abstraction_errors.append(np.max(distances))
+    def __getstate__(self):
+        # The abstraction is not needed for scoring and is not shipped to worker processes (which start with an empty memo)
+        state = self.__dict__.copy()
+        state['A'] = None
+        state['memo'] = collections.OrderedDict()
+        del state['memo_lock']
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.memo_lock = threading.Lock()
+    
+    def clear_memo(self):
+        self.memo_lock = threading.Lock()
+        self.memo = collections.OrderedDict()
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.memo_evictions = 0
+        
+    def memo_info(self):
+        n_queries = self.memo_hits + self.memo_misses
+        return {'hits': self.memo_hits, 'misses': self.memo_misses, 'evictions': self.memo_evictions,
+                'size': len(self.memo), 'maxsize': self.memo_size, 'hit_rate': self.memo_hits/n_queries if n_queries>0 else 0.0}
+    
+    def _compute_pair_error(self, k, alphas, metric=None, verbose=False, debug=False):
+        (M1_sources,M1_targets),(M0_cond_TS_val,M1_cond_TS_val) = self.J[k],self.mechanisms[k]
+        if self.memo_size == 0 or verbose or debug:
+            return compute_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,alphas,
+                                             metric=metric,cardinalities=self.cardinalities,verbose=verbose,debug=debug)
+        
+        key = (k,metric,tuple(_hash_alpha(alphas[x]) for x in M1_sources+M1_targets))
+        with self.memo_lock:
+            if key in self.memo:
+                self.memo_hits += 1
+                self.memo.move_to_end(key)
+                return self.memo[key]
+            self.memo_misses += 1
+        
+        # The error is computed outside the lock, so that concurrent threads may run their products in parallel
+        error = compute_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,alphas,
+                                          metric=metric,cardinalities=self.cardinalities)
+        with self.memo_lock:
+            self.memo[key] = error
+            if len(self.memo) > self.memo_size:
+                self.memo.popitem(last=False)
+                self.memo_evictions += 1
+        return error
+
+    def score(self, alphas, metric=None, verbose=False, debug=False):
+        if metric is None:
+            metric = distance.jensenshannon
+
+        abstraction_errors = []
+        for k,(M1_sources,M1_targets) in enumerate(self.J):
+            if verbose: print('\nM1: {0} -> {1}'.format(M1_sources,M1_targets))
+            abstraction_errors.append(self._compute_pair_error(k,alphas,metric=metric,verbose=verbose,debug=debug))
 
-        # Select the greatest distance over all pairs considered
         if verbose: print('\n\nOVERALL ABSTRACTION ERROR: {0}'.format(np.max(abstraction_errors)))
-            
+
         return abstraction_errors
-    
-    def evaluate_overall_abstraction_error(self, metric=None, J=None,J_algorithm=None, verbose=False):
-        errors = np.array(self.evaluate_abstraction_errors(metric=metric,J=J,J_algorithm=J_algorithm,verbose=verbose))
+
+    def score_overall(self, alphas, metric=None, stop_above=None, verbose=False):
+        if stop_above is not None:
+            return self._score_bounded(alphas,stop_above,metric=metric,verbose=verbose)
+        
+        errors = np.array(self.score(alphas,metric=metric,verbose=verbose))
         errors[np.argwhere(np.isnan(errors))] = 0
         return np.max(errors)
     
-    def evaluate_cumulative_abstraction_errors(self, metric=None, J=None,J_algorithm=None, verbose=False):
-        errors = np.array(self.evaluate_abstraction_errors(metric=metric,J=J,J_algorithm=J_algorithm,verbose=verbose))
+    def _score_bounded(self, alphas, stop_above, metric=None, verbose=False):
+        # Evaluation stops as soon as a pair has an error greater than stop_above, and such error is returned
+        overall_error = 0
+        for k in np.lexsort((self.costs,-self.error_history)):
+            error = self.score_pair(k,alphas,metric=metric,verbose=verbose)
+            self.error_history[k] = error
+            overall_error = max(overall_error,error)
+            if overall_error > stop_above: break
+        
+        return overall_error
+    
+    def score_pair(self, k, alphas, metric=None, verbose=False):
+        # The error of the k-th pair only depends on the alphas of its sources and targets; undefined errors count as zero
+        error = self._compute_pair_error(k,alphas,metric=metric,verbose=verbose)
+        return 0.0 if np.isnan(error) else error
+
+    def score_cumulative(self, alphas, metric=None, verbose=False):
+        errors = np.array(self.score(alphas,metric=metric,verbose=verbose))
         errors[np.argwhere(np.isnan(errors))] = 0
         return np.sum(errors)
+
+    def score_batch(self, alphas, metric=None, reduction='overall', chunk_size=None, max_elements=2**24):
+        """
+        Score a batch of candidate alphas at once, replacing the products with the alphas of every pair by batched products.
+
+        Args:
+            alphas: dictionary mapping each node of M1 to a stack of candidate alphas, either a 3D numpy array of matrices
+                [candidates x codomain x domain] or a 2D integer array of vectors [candidates x domain] (see map_matrix2vect)
+            metric: None, the name of a registered metric, or a callable (custom callables are evaluated candidate by candidate)
+            reduction: 'overall' (greatest pair error) or 'cumulative' (sum of the pair errors)
+            chunk_size: number of candidates processed together (default: the largest number keeping the intermediate arrays
+                of every pair within max_elements, estimated from the shapes of the mechanisms and of the alphas)
+            max_elements: maximum number of elements of the intermediate arrays of a chunk
+
+        Returns:
+            1D numpy array of errors, one for each candidate
+        """
+        if reduction not in ('overall','cumulative'): raise ValueError("Unknown reduction {0}".format(reduction))
+        n_candidates = _get_batch_size(alphas)
+        if chunk_size is None: chunk_size = self._get_batch_chunk_size(alphas,max_elements)
+        
+        errors = np.zeros(n_candidates)
+        for start in range(0,n_candidates,chunk_size):
+            chunk = {x: alpha[start:start+chunk_size] for x,alpha in alphas.items()}
+            for (M1_sources,M1_targets),(M0_cond_TS_val,M1_cond_TS_val) in zip(self.J,self.mechanisms):
+                pair_errors = compute_batch_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,chunk,
+                                                              metric=metric,cardinalities=self.cardinalities)
+                # Undefined errors count as zero
+                pair_errors = np.nan_to_num(pair_errors,nan=0.0)
+                if reduction == 'overall':
+                    errors[start:start+chunk_size] = np.maximum(errors[start:start+chunk_size],pair_errors)
+                else:
+                    errors[start:start+chunk_size] += pair_errors
+        return errors
     
-    def is_exact(self, metric=None,J=None,J_algorithm=None,verbose=False, rtol=1e-05, atol=1e-08):
-        error = self.evaluate_overall_abstraction_error(metric=metric,J=J,J_algorithm=J_algorithm,verbose=verbose)
-        return np.isclose(0,error,rtol=rtol,atol=atol)
+    def _get_batch_chunk_size(self, alphas, max_elements):
+        # Upper bound, for a single candidate, of the elements of the arrays built by compute_batch_abstraction_error for any pair
+        dims = {x: (alpha.shape[1],alpha.shape[2]) if np.ndim(alpha)==3 else (self.cardinalities[x],alpha.shape[1]) for x,alpha in alphas.items()}
+        def get_factor_size(nodes): return int(np.prod([max(dims[x]) for x in nodes],dtype=np.float64))
         
+        elements = 1
+        for (M1_sources,M1_targets),(M0_cond_TS_val,M1_cond_TS_val) in zip(self.J,self.mechanisms):
+            if _are_batch_alpha_vectors([alphas[x] for x in M1_sources]):
+                lower = M1_cond_TS_val.shape[0]*M0_cond_TS_val.shape[1]
+            else:
+                lower = M1_cond_TS_val.shape[0]*get_factor_size(M1_sources)
+            if _are_batch_alpha_vectors([alphas[x] for x in M1_targets]):
+                upper = 3*M0_cond_TS_val.size
+            else:
+                upper = get_factor_size(M1_targets)*M0_cond_TS_val.shape[1]
+            elements = max(elements,lower+upper)
+        return max(1,int(max_elements // elements))
+
+def compute_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,alphas,metric=None,cardinalities=None,verbose=False,debug=False):
+    """
+    Compute the abstraction error of a single diagram as the greatest distance between the two paths over all interventions.
+
+    Args:
+        M0_cond_TS_val: 2D numpy array of the low-level mechanism [targets x sources]
+        M1_cond_TS_val: 2D numpy array of the high-level mechanism [targets x sources]
+        M1_sources: list of source nodes in M1
+        M1_targets: list of target nodes in M1
+        alphas: dictionary of alphas, each one either a matrix or, if deterministic, an integer vector (see map_matrix2vect)
+        metric: distance between distributions (default: Jensen-Shannon distance)
+        cardinalities: dictionary of the cardinalities of the nodes in M1 (required for alphas encoded as vectors)
+
+    Returns:
+        The abstraction error of the diagram
+    """
+    if metric is None:
+        metric = distance.jensenshannon
+
+    # Compute the alpha for sources (kept as a list of factors of the tensor product)
+    alphas_S = [alphas[i] for i in M1_sources]
+    rows_S = _get_alpha_rows(alphas_S,M1_sources,cardinalities)
+    if verbose: print('Alpha_s shape: {}'.format(_get_tensorized_shape(alphas_S,rows_S)))
+
+    # Compute the alpha for targers (kept as a list of factors of the tensor product)
+    alphas_T = [alphas[i] for i in M1_targets]
+    rows_T = _get_alpha_rows(alphas_T,M1_targets,cardinalities)
+    if verbose: print('Alpha_t shape: {}'.format(_get_tensorized_shape(alphas_T,rows_T)))
+
+    # Evaluate the paths on the diagram
+    if _are_alpha_vectors(alphas_S):
+        lowerpath = ut.gather_columns(M1_cond_TS_val,ut.kron_index(alphas_S,rows_S))
+    else:
+        lowerpath = ut.dot_kron(M1_cond_TS_val,_get_alpha_matrices(alphas_S,rows_S))
+    if _are_alpha_vectors(alphas_T):
+        upperpath = ut.aggregate_rows(ut.kron_index(alphas_T,rows_T),M0_cond_TS_val,int(np.prod(rows_T)))
+    else:
+        upperpath = ut.kron_dot(_get_alpha_matrices(alphas_T,rows_T),M0_cond_TS_val)
+
+    # Compute abstraction error for every possible intervention
+    if debug: print('{0} \n\n {1}'.format(lowerpath,upperpath))
+    distances = metrics.compute_distances(lowerpath,upperpath,metric=metric)
+    if verbose: print('All JS distances: {0}'.format(distances))
+
+    # Select the greatest distance over all interventions
+    if verbose: print('\nAbstraction error: {0}'.format(np.max(distances)))
+    return np.max(distances)
+
+def compute_batch_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,alphas,metric=None,cardinalities=None):
+    """
+    Compute the abstraction error of a single diagram for a batch of candidate alphas.
+
+    Args:
+        M0_cond_TS_val: 2D numpy array of the low-level mechanism [targets x sources]
+        M1_cond_TS_val: 2D numpy array of the high-level mechanism [targets x sources]
+        M1_sources: list of source nodes in M1
+        M1_targets: list of target nodes in M1
+        alphas: dictionary of stacks of alphas, either 3D arrays of matrices or 2D integer arrays of vectors (see score_batch)
+        metric: distance between distributions (default: Jensen-Shannon distance)
+        cardinalities: dictionary of the cardinalities of the nodes in M1 (required for alphas encoded as vectors)
+
+    Returns:
+        1D numpy array of the abstraction errors of the diagram, one for each candidate
+    """
+    n_candidates = _get_batch_size(alphas)
+    alphas_S = [alphas[i] for i in M1_sources]; rows_S = _get_batch_alpha_rows(alphas_S,M1_sources,cardinalities)
+    alphas_T = [alphas[i] for i in M1_targets]; rows_T = _get_batch_alpha_rows(alphas_T,M1_targets,cardinalities)
+    
+    # Evaluate the paths on the diagram for all the candidates, as arrays [candidates x targets x interventions]
+    if _are_batch_alpha_vectors(alphas_S):
+        lowerpath = np.transpose(M1_cond_TS_val[:,_batch_kron_index(alphas_S,rows_S)],(1,0,2))
+    else:
+        lowerpath = _batch_dot_kron(M1_cond_TS_val,_get_batch_alpha_matrices(alphas_S,rows_S))
+    if _are_batch_alpha_vectors(alphas_T):
+        upperpath = _batch_aggregate_rows(_batch_kron_index(alphas_T,rows_T),M0_cond_TS_val,int(np.prod(rows_T)))
+    else:
+        upperpath = _batch_kron_dot(_get_batch_alpha_matrices(alphas_T,rows_T),M0_cond_TS_val)
+    
+    # Compute abstraction error for every possible intervention and select the greatest one
+    kernel = metrics.get_vectorized_metric(metric)
+    if kernel is not None:
+        distances = kernel(np.moveaxis(lowerpath,1,0),np.moveaxis(upperpath,1,0))
+    else:
+        distances = np.array([metrics.compute_distances(lowerpath[b],upperpath[b],metric=metric) for b in range(n_candidates)])
+    return np.max(distances,axis=1)
+
+def _get_batch_size(alphas):
+    sizes = set(np.shape(alpha)[0] for alpha in alphas.values())
+    if len(sizes) != 1: raise ValueError("All the stacks of alphas must contain the same number of candidates")
+    return sizes.pop()
+
+def _are_batch_alpha_vectors(l):
+    return all(np.ndim(x)==2 for x in l)
+
+def _get_batch_alpha_rows(l,nodes,cardinalities):
+    if cardinalities is None and any(np.ndim(x)==2 for x in l): raise ValueError("Cardinalities are required to apply alphas encoded as vectors")
+    return [x.shape[1] if np.ndim(x)==3 else cardinalities[n] for x,n in zip(l,nodes)]
+
+def _get_batch_alpha_matrices(l,rows):
+    # Integer vectors are one-hot encoded along the rows
+    return [x if np.ndim(x)==3 else (np.arange(r)[None,:,None]==np.asarray(x)[:,None,:]).astype(np.float64) for x,r in zip(l,rows)]
+
+def _batch_kron_index(l,rows):
+    # Batched equivalent of utils.kron_index: the last factor varies fastest
+    idx = np.zeros((l[0].shape[0],1),dtype=np.int64)
+    for v,r in zip(l,rows):
+        idx = (idx[:,:,None]*r + np.asarray(v)[:,None,:]).reshape((idx.shape[0],-1))
+    return idx
+
+def _batch_kron_dot(l,M):
+    # Batched equivalent of utils.kron_dot: the factors are applied one axis at a time (mode-n products) as batched matrix products,
+    # without materializing the tensor product of each candidate
+    n_candidates = l[0].shape[0]; ncols = M.shape[1]
+    T = np.tensordot(l[0],M.reshape((l[0].shape[2],-1)),axes=([2],[0]))
+    T = T.reshape([n_candidates,l[0].shape[1]]+[x.shape[2] for x in l[1:]]+[ncols])
+    for i in range(1,len(l)):
+        T = np.moveaxis(T,i+1,1)
+        shape = T.shape
+        T = np.matmul(l[i],T.reshape((n_candidates,shape[1],-1))).reshape((n_candidates,l[i].shape[1])+shape[2:])
+        T = np.moveaxis(T,1,i+1)
+    return T.reshape((n_candidates,int(np.prod([x.shape[1] for x in l])),ncols))
+
+def _batch_dot_kron(M,l):
+    # Batched equivalent of utils.dot_kron, through the transpose M.(A x B) = ((A^T x B^T).M^T)^T
+    return np.swapaxes(_batch_kron_dot([np.swapaxes(x,1,2) for x in l],M.T),1,2)
+
+def _batch_aggregate_rows(idx,M,rows):
+    # Batched equivalent of utils.aggregate_rows, computed with a single bincount over all the candidates
+    n_candidates = idx.shape[0]; ncols = M.shape[1]
+    bins = ((np.arange(n_candidates)[:,None]*rows + idx)[:,:,None]*ncols + np.arange(ncols)).ravel()
+    res = np.bincount(bins,weights=np.broadcast_to(M,(n_candidates,)+M.shape).ravel(),minlength=n_candidates*rows*ncols)
+    return res.reshape((n_candidates,rows,ncols))
+
+_worker_state = {}
+
+def _init_worker(shm_name,specs,models,a,alpha_keys,metric):
+    shm,arrays = parallel.attach_arrays(shm_name,specs)
+    # The shared memory block is kept referenced for the lifetime of the worker
+    _worker_state['shm'] = shm
+    for name,(variables,cardinalities,nodes) in models.items():
+        factors = {node: (variables[node],arrays[(name,node)]) for node in variables}
+        _worker_state[name] = ContractionInference.from_factors(factors,cardinalities,nodes)
+    _worker_state['alphas'] = {k: arrays[('alpha',k)] for k in alpha_keys}
+    _worker_state['a'] = a
+    _worker_state['metric'] = metric
+
+def _evaluate_group_in_worker(group):
+    inferM0 = _worker_state['M0']; inferM1 = _worker_state['M1']
+    invert_a = functools.partial(ut.inverse_fx,_worker_state['a'])
+    
+    errors = []
+    mechanisms = _iter_group_mechanisms([pair for _,pair in group],inferM0,inferM1,invert_a,Abstraction.compute_mechanisms,
+                                        inferM0.cardinalities,inferM1.cardinalities)
+    for (k,_),(M1_sources,M1_targets,M0_cond_TS_val,M1_cond_TS_val) in zip(group,mechanisms):
+        errors.append((k,compute_abstraction_error(M0_cond_TS_val,M1_cond_TS_val,M1_sources,M1_targets,_worker_state['alphas'],
+                                                   metric=_worker_state['metric'],cardinalities=inferM1.cardinalities)))
+    return errors
+
+def _is_picklable(obj):
+    try:
+        pickle.dumps(obj)
+    except Exception:
+        return False
+    return True
+
+def _hash_alpha(alpha):
+    alpha = np.ascontiguousarray(alpha)
+    return hashlib.blake2b(alpha.tobytes()+str((alpha.shape,alpha.dtype.str)).encode(),digest_size=16).digest()
+
+def _get_maximal_sets(sets):
+    # Visiting larger sets first, a set is maximal iff it is not contained in a maximal set found before
+    maximal_sets = []
+    for x in sorted(sets,key=len,reverse=True):
+        if not any(set(x) <= set(m) for m in maximal_sets):
+            maximal_sets.append(x)
+    return maximal_sets
+
+def _get_maximal_superset(x,maximal_sets):
+    for m in maximal_sets:
+        if set(x) <= set(m): return m
+
+def _are_alpha_vectors(l):
+    return all(np.ndim(x)==1 for x in l)
+
+def _get_alpha_rows(l,nodes,cardinalities):
+    if cardinalities is None and any(np.ndim(x)==1 for x in l): raise ValueError("Cardinalities are required to apply alphas encoded as vectors")
+    return [x.shape[0] if np.ndim(x)==2 else cardinalities[n] for x,n in zip(l,nodes)]
+
+def _get_alpha_matrices(l,rows):
+    return [x if np.ndim(x)==2 else ut.map_vect2matrix(x,r) for x,r in zip(l,rows)]
+
+def _get_tensorized_shape(l,rows):
+    return (int(np.prod(rows)), int(np.prod([len(x) if np.ndim(x)==1 else x.shape[1] for x in l])))
+
 class AbstractionInfoLossEvaluator(AbstractionEvaluator):
     def __init__(self,A):
         super().__init__(A)
@@ -121,46 +655,21 @@ class AbstractionEffectiveInformationEvaluator(AbstractionEvaluator):
     def __init__(self,A):
         super().__init__(A)
         
-    def evaluate_EIs(self, J_algorithm=None, base=2, verbose=False, debug=False):
+    def evaluate_EIs(self, J_algorithm=None, base=2, backend='pgmpy', verbose=False, debug=False):
         if J_algorithm is None:
-            J = es.get_sets_in_M1_with_directed_path_in_M1_or_M0(self.A.M0,self.A.M1,self.A.a,verbose=verbose)
+            J = es.iter_sets_in_M1_with_directed_path_in_M1_or_M0(self.A.M0,self.A.M1,self.A.a,verbose=verbose)
         else:
             J = J_algorithm(self.A)
             
-        EIs_low = []; EIs_high = []
-
-        for pair in J:
-            # Get nodes in the abstracted model
-            M1_sources = pair[0]
-            M1_targets = pair[1]
-            if verbose: print('\nM1: {0} -> {1}'.format(M1_sources,M1_targets))
-
-            # Get nodes in the base model
-            M0_sources = self.A.invert_a(M1_sources)
-            M0_targets = self.A.invert_a(M1_targets)
-            if verbose: print('M0: {0} -> {1}'.format(M0_sources,M0_targets))
-
-            # Perform interventions in the abstracted model and setup the inference engine
-            M1do = self.A.M1.do(M1_sources)
-            inferM1 = VariableElimination(M1do)
-
-            # Perform interventions in the base model and setup the inference engine
-            M0do = self.A.M0.do(M0_sources)
-            inferM0 = VariableElimination(M0do)
-
-            # Compute the high-level mechanisms
-            M1_cond_TS_val = self.A.compute_mechanisms(inferM1,M1_sources,M1_targets,self.A.M1.get_cardinality())
-            if verbose: print('M1 mechanism shape: {}'.format(M1_cond_TS_val.shape))
-
-            # Compute the low-level mechanisms
-            M0_cond_TS_val = self.A.compute_mechanisms(inferM0,M0_sources,M0_targets,self.A.M0.get_cardinality())
-            if verbose: print('M0 mechanism shape: {}'.format(M0_cond_TS_val.shape))
+        EIs = {}
 
-            # Compute the EI for the mechanisms
+        for k,(_,_,M0_cond_TS_val,M1_cond_TS_val) in self._iter_mechanisms(J,backend=backend,verbose=verbose):
+            # Compute the EI for the mechanisms, placed at the index of their pair in J
             _,EI_low = mm.EI(M0_cond_TS_val)
             _,EI_high = mm.EI(M1_cond_TS_val)
-            EIs_low.append(EI_low)
-            EIs_high.append(EI_high)
+            EIs[k] = (EI_low,EI_high)
+        EIs_low = [EIs[k][0] for k in range(len(EIs))]
+        EIs_high = [EIs[k][1] for k in range(len(EIs))]
 
         # Output all the EIs computed
         if verbose: print('All EIs in low-level model: {0}'.format(EIs_low))
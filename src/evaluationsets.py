@@ -1,10 +1,52 @@
 
-import numpy as np
 import networkx as nx
 import itertools
 import src.utils as ut
 
     
+class InconsistentDiagramError(ValueError):
+    pass
+
+
+class ReachabilityIndex():
+    """
+    Transitive closure of a graph encoded as integer bitmasks, where the i-th bit denotes the i-th node of the graph.
+    
+    The index is computed once, after which every test of reachability between sets of nodes reduces to bitwise operations.
+    """
+    def __init__(self,G):
+        self.nodes = list(G.nodes())
+        self.bits = {n:1<<i for i,n in enumerate(self.nodes)}
+        # Every node reaches (and is reached by) itself, consistently with nx.has_path
+        self.descendants = {n: self.bits[n] | self.mask(nx.descendants(G,n)) for n in self.nodes}
+        self.ancestors = {n: self.bits[n] | self.mask(nx.ancestors(G,n)) for n in self.nodes}
+        
+    def mask(self,nodes):
+        m = 0
+        for n in nodes: m |= self.bits[n]
+        return m
+    
+    def reach(self,nodes):
+        m = 0
+        for n in nodes: m |= self.descendants[n]
+        return m
+    
+    def has_path(self,source,target):
+        return self.descendants[source] & self.bits[target] != 0
+    
+    def has_path_between_sets(self,sources,targets):
+        return self.reach(sources) & self.mask(targets) != 0
+    
+    def has_path_between_each_source_and_target(self,sources,targets):
+        smask = self.mask(sources)
+        tmask = self.mask(targets)
+        for s in sources:
+            if not(self.descendants[s] & tmask): return False
+        for t in targets:
+            if not(self.ancestors[t] & smask): return False
+        return True
+    
+
 def check_path_between_sets(G,sources,targets):
     """
     It computes whether there is a path between a set of source nodes and a set of target nodes.
@@ -17,17 +59,8 @@ def check_path_between_sets(G,sources,targets):
     Returns:
         True if there is a path in G between source and target
     """
-    augmentedG = G.copy()
-
-    augmented_s = 'augmented_s_'+str(np.random.randint(10**6))
-    augmented_t = 'augmented_t_'+str(np.random.randint(10**6))
-    augmentedG.add_node(augmented_s)
-    augmentedG.add_node(augmented_t)
-
-    [augmentedG.add_edge(augmented_s,s) for s in sources]
-    [augmentedG.add_edge(t,augmented_t) for t in targets]
-
-    return nx.has_path(augmentedG,augmented_s,augmented_t)
+    reachable = set(sources).union(*[nx.descendants(G,s) for s in sources])
+    return any(t in reachable for t in targets)
 
 
 def check_path_between_each_source_and_target(G,sources,targets):
@@ -61,6 +94,33 @@ def check_path_between_each_source_and_target(G,sources,targets):
     return True
 
 
+def _iter_disjoint_sets(nodes):
+    """
+    It iterates over all the non-empty subsets S of nodes, each one with the iterator over the non-empty subsets T disjoint from S; 
+    pairs (S,T) are visited in the same order as a double loop over the power set.
+    
+    The subsets T disjoint from S are generated directly as the power set of the complement of S, which preserves the ordering of the power set of nodes.
+    """
+    for i in ut.powerset(nodes):
+        if len(i)==0: continue
+        complement = [n for n in nodes if n not in i]
+        yield list(i), (list(j) for j in ut.powerset(complement) if len(j)>0)
+            
+def _get_inverse_a(a,nodes):
+    return {x: ut.inverse_fx(a,x) for x in nodes}
+
+def _apply_inverse_a(inverse_a,nodes):
+    return list(itertools.chain.from_iterable(inverse_a[x] for x in nodes))
+
+def _get_inverse_masks(index,inverse_a):
+    return {x: index.mask(v) for x,v in inverse_a.items()}
+
+def _apply_masks(masks,nodes):
+    m = 0
+    for n in nodes: m |= masks[n]
+    return m
+
+
 def get_all_pairs(M):
     """
     It computes all the pairs of nodes
@@ -85,11 +145,12 @@ def get_pairs_with_directed_path(M):
         J: list of all the pairs of connected nodes
     """
     J = []
+    index = ReachabilityIndex(M)
     sources = list(M.nodes())
     targets = list(M.nodes())
     for s in sources:
         for t in list(set(targets)-{s}):
-            if nx.has_path(M,s,t):
+            if index.has_path(s,t):
                 J.append((s,t))
     return J
         
@@ -106,19 +167,57 @@ def get_pairs_in_M1_with_directed_path_in_M1_or_M0(M0,M1,a):
         J: list of all the pairs of connected nodes either in M1 or in M0
     """
     J = []
+    index_M0 = ReachabilityIndex(M0)
+    index_M1 = ReachabilityIndex(M1)
+    inverse_a = _get_inverse_a(a,M1.nodes())
     sources = list(M1.nodes())
     targets = list(M1.nodes())
     for s in sources:
         for t in list(set(targets)-{s}):
-            if nx.has_path(M1,s,t):
+            if index_M1.has_path(s,t):
                 J.append((s,t))
             else:
-                M0_sources = ut.inverse_fx(a,s)
-                M0_targets = ut.inverse_fx(a,t)
-                if check_path_between_sets(M0,M0_sources,M0_targets):
+                if index_M0.has_path_between_sets(inverse_a[s],inverse_a[t]):
                     J.append((s,t))
     return J
     
+def count_disjoint_sets(M):
+    """
+    It computes the number of pairs of non-empty disjoint sets (S,T) of nodes in M, that is the number of candidate pairs checked by the set generators.
+
+    Args:
+        M: a pgmpy BN model
+        
+    Returns:
+        Integer 3^n - 2^(n+1) + 1, where n is the number of nodes; this is an upper bound to the size of any evaluation set J
+    """
+    n = len(M.nodes())
+    return 3**n - 2**(n+1) + 1
+
+def iter_sets_in_M1_with_directed_path_in_M1_or_M0(M0,M1,a,verbose=False):
+    """
+    Generator version of get_sets_in_M1_with_directed_path_in_M1_or_M0, yielding the pairs [S,T] one at a time in the same order.
+    """
+    index_M0 = ReachabilityIndex(M0)
+    index_M1 = ReachabilityIndex(M1)
+    inverse_a = _get_inverse_a(a,index_M1.nodes)
+    inverse_masks = _get_inverse_masks(index_M0,inverse_a)
+
+    for M1_sources,all_M1_targets in _iter_disjoint_sets(index_M1.nodes):
+        reach_M1 = index_M1.reach(M1_sources)
+        reach_M0 = index_M0.reach(_apply_inverse_a(inverse_a,M1_sources))
+        for M1_targets in all_M1_targets:
+            if reach_M1 & index_M1.mask(M1_targets):
+                if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
+                yield [M1_sources,M1_targets]
+            else:
+                if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
+                if reach_M0 & _apply_masks(inverse_masks,M1_targets):
+                    if verbose: print('---- Checking {0} -> {1}: True'.format(ut.inverse_fx(a,M1_sources),ut.inverse_fx(a,M1_targets)))
+                    yield [M1_sources,M1_targets]
+                else:
+                    if verbose: print('---- Checking {0} -> {1}: False'.format(ut.inverse_fx(a,M1_sources),ut.inverse_fx(a,M1_targets)))
+    
 def get_sets_in_M1_with_directed_path_in_M1_or_M0(M0,M1,a,verbose=False):
     """
     For each pair of disjoint sets (S,T) of nodes in M1, the pair is added to the list if (i) there is at least one path from S to T in M1; OR (ii) there is at least one path from a^-1(S) to a^-1(T)  
@@ -131,31 +230,37 @@ def get_sets_in_M1_with_directed_path_in_M1_or_M0(M0,M1,a,verbose=False):
     Returns:
         J: list of all the sets of connected nodes either in M1 or in M0
     """
-    J = []
-    sets = list(ut.powerset(M1.nodes()))
-    sets.remove(())
-
-    for i in sets:
-        for j in sets:
-            M1_sources = list(i)
-            M1_targets = list(j)
-            if not(any(x in M1_sources for x in M1_targets)):            
-                if check_path_between_sets(M1,M1_sources,M1_targets):
-                    if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
-                    J.append([M1_sources,M1_targets])
-                else:
-                    if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
-                    M0_sources = ut.inverse_fx(a,M1_sources)
-                    M0_targets = ut.inverse_fx(a,M1_targets)
-                    if check_path_between_sets(M0,M0_sources,M0_targets):
-                        if verbose: print('---- Checking {0} -> {1}: True'.format(M0_sources,M0_targets))
-                        J.append([M1_sources,M1_targets])
-                    else:
-                        if verbose: print('---- Checking {0} -> {1}: False'.format(M0_sources,M0_targets))
-    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),len(sets)**2))  
+    J = list(iter_sets_in_M1_with_directed_path_in_M1_or_M0(M0,M1,a,verbose=verbose))
+    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),(2**len(M1.nodes())-1)**2))  
 
     return J
 
+def iter_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
+    """
+    Generator version of get_sets_in_M1_with_directed_path_in_M1_and_M0, yielding the pairs [S,T] one at a time in the same order.
+    
+    Raises InconsistentDiagramError when reaching a pair connected in M1 but not in M0.
+    """
+    index_M0 = ReachabilityIndex(M0)
+    index_M1 = ReachabilityIndex(M1)
+    inverse_a = _get_inverse_a(a,index_M1.nodes)
+    inverse_masks = _get_inverse_masks(index_M0,inverse_a)
+
+    for M1_sources,all_M1_targets in _iter_disjoint_sets(index_M1.nodes):
+        reach_M1 = index_M1.reach(M1_sources)
+        reach_M0 = index_M0.reach(_apply_inverse_a(inverse_a,M1_sources))
+        for M1_targets in all_M1_targets:
+            if reach_M1 & index_M1.mask(M1_targets):
+                if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
+                if reach_M0 & _apply_masks(inverse_masks,M1_targets):
+                    if verbose: print('---- Checking {0} -> {1}: True'.format(ut.inverse_fx(a,M1_sources),ut.inverse_fx(a,M1_targets)))
+                    yield [M1_sources,M1_targets]
+                else:
+                    if verbose: print('---- Checking {0} -> {1}: False'.format(ut.inverse_fx(a,M1_sources),ut.inverse_fx(a,M1_targets)))
+                    raise InconsistentDiagramError("Found an inconsistent diagram: {0} -> {1}".format(M1_sources,M1_targets))
+            else:
+                if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
+
 def get_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
     """
     For each pair of disjoint sets (S,T) of nodes in M1, the pair is added to the list if (i) there is at least one path from S to T in M1; AND (ii) there is at least one path from a^-1(S) to a^-1(T)  
@@ -168,34 +273,26 @@ def get_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
     Returns:
         J: list of all the sets of connected nodes both in M1 and in M0
     """
-    J = []
-    sets = list(ut.powerset(M1.nodes()))
-    sets.remove(())
-
-    for i in sets:
-        for j in sets:
-            M1_sources = list(i)
-            M1_targets = list(j)
-            if not(any(x in M1_sources for x in M1_targets)):            
-                if check_path_between_sets(M1,M1_sources,M1_targets):
-                    if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
-                    M0_sources = ut.inverse_fx(a,M1_sources)
-                    M0_targets = ut.inverse_fx(a,M1_targets)
-                    if check_path_between_sets(M0,M0_sources,M0_targets):
-                        if verbose: print('---- Checking {0} -> {1}: True'.format(M0_sources,M0_targets))
-                        J.append([M1_sources,M1_targets])
-                    else:
-                        if verbose: print('---- Checking {0} -> {1}: False'.format(M0_sources,M0_targets))
-                        if verbose: print('Found an inconsistent diagram. Returning None')
-                        return None
-                else:
-                    if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
+    try:
+        J = list(iter_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=verbose))
+    except InconsistentDiagramError:
+        if verbose: print('Found an inconsistent diagram. Returning None')
+        return None
                     
-    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),len(sets)**2))  
+    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),(2**len(M1.nodes())-1)**2))  
 
     return J
 
 
+def iter_causal_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
+    """
+    Generator version of get_causal_sets_in_M1_with_directed_path_in_M1_and_M0, yielding the pairs [S,T] one at a time in the same order.
+    
+    Raises InconsistentDiagramError when reaching a pair causally connected in M1 but not in M0.
+    """
+    for M1_pair,_ in iter_causal_sets_in_M1_M0_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=verbose):
+        yield M1_pair
+
 def get_causal_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
     """
     For each pair of disjoint sets (S,T) of nodes in M1, the pair is added to the list if (i) every node in S reaches a node in T and every node in T is reached by a node in S; AND (ii) every node in a^-1(S) reaches a node in a^-1(T) and every node in a^-1(T) is reached by a node in a^-1(S) 
@@ -208,60 +305,47 @@ def get_causal_sets_in_M1_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False)
     Returns:
         J: list of all the sets of connected nodes both in M1 and in M0
     """
-    J = []
-    sets = list(ut.powerset(M1.nodes()))
-    sets.remove(())
-
-    for i in sets:
-        for j in sets:
-            M1_sources = list(i)
-            M1_targets = list(j)
-            if not(any(x in M1_sources for x in M1_targets)):            
-                if check_path_between_each_source_and_target(M1,M1_sources,M1_targets):
-                    if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
+    res = get_causal_sets_in_M1_M0_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=verbose)
+    if res is None: return None
+    return res[0]
+
+
+def iter_causal_sets_in_M1_M0_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
+    """
+    Generator version of get_causal_sets_in_M1_M0_with_directed_path_in_M1_and_M0, yielding the pairs ([S,T],[a^-1(S),a^-1(T)]) one at a time in the same order.
+    
+    Raises InconsistentDiagramError when reaching a pair causally connected in M1 but not in M0.
+    """
+    index_M0 = ReachabilityIndex(M0)
+    index_M1 = ReachabilityIndex(M1)
+    inverse_a = _get_inverse_a(a,index_M1.nodes)
+
+    for M1_sources,all_M1_targets in _iter_disjoint_sets(index_M1.nodes):
+        for M1_targets in all_M1_targets:
+            if index_M1.has_path_between_each_source_and_target(M1_sources,M1_targets):
+                if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
+                if index_M0.has_path_between_each_source_and_target(_apply_inverse_a(inverse_a,M1_sources),_apply_inverse_a(inverse_a,M1_targets)):
                     M0_sources = ut.inverse_fx(a,M1_sources)
                     M0_targets = ut.inverse_fx(a,M1_targets)
-                    if check_path_between_each_source_and_target(M0,M0_sources,M0_targets):
-                        if verbose: print('---- Checking {0} -> {1}: True'.format(M0_sources,M0_targets))
-                        J.append([M1_sources,M1_targets])
-                    else:
-                        if verbose: print('---- Checking {0} -> {1}: False'.format(M0_sources,M0_targets))
-                        if verbose: print('Found an inconsistent diagram. Returning None')
-                        return None
+                    if verbose: print('---- Checking {0} -> {1}: True'.format(M0_sources,M0_targets))
+                    yield [M1_sources,M1_targets],[M0_sources,M0_targets]
                 else:
-                    if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
-                    
-    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),len(sets)**2))  
-
-    return J
-
+                    if verbose: print('---- Checking {0} -> {1}: False'.format(ut.inverse_fx(a,M1_sources),ut.inverse_fx(a,M1_targets)))
+                    raise InconsistentDiagramError("Found an inconsistent diagram: {0} -> {1}".format(M1_sources,M1_targets))
+            else:
+                if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
 
 def get_causal_sets_in_M1_M0_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=False):
     J = []
     O = []
-    sets = list(ut.powerset(M1.nodes()))
-    sets.remove(())
-
-    for i in sets:
-        for j in sets:
-            M1_sources = list(i)
-            M1_targets = list(j)
-            if not(any(x in M1_sources for x in M1_targets)):            
-                if check_path_between_each_source_and_target(M1,M1_sources,M1_targets):
-                    if verbose: print('- Checking {0} -> {1}: True'.format(M1_sources,M1_targets))
-                    M0_sources = ut.inverse_fx(a,M1_sources)
-                    M0_targets = ut.inverse_fx(a,M1_targets)
-                    if check_path_between_each_source_and_target(M0,M0_sources,M0_targets):
-                        if verbose: print('---- Checking {0} -> {1}: True'.format(M0_sources,M0_targets))
-                        J.append([M1_sources,M1_targets])
-                        O.append([M0_sources,M0_targets])
-                    else:
-                        if verbose: print('---- Checking {0} -> {1}: False'.format(M0_sources,M0_targets))
-                        if verbose: print('Found an inconsistent diagram. Returning None')
-                        return None
-                else:
-                    if verbose: print('- Checking {0} -> {1}: False'.format(M1_sources,M1_targets))
+    try:
+        for M1_pair,M0_pair in iter_causal_sets_in_M1_M0_with_directed_path_in_M1_and_M0(M0,M1,a,verbose=verbose):
+            J.append(M1_pair)
+            O.append(M0_pair)
+    except InconsistentDiagramError:
+        if verbose: print('Found an inconsistent diagram. Returning None')
+        return None
                     
-    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),len(sets)**2))  
+    if verbose: print('\n {0} legitimate pairs of sets out of {1} possbile pairs of sets'.format(len(J),(2**len(M1.nodes())-1)**2))  
 
-    return J, O
\ No newline at end of file
+    return J, O
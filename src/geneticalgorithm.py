@@ -1,5 +1,13 @@
 
+import os
+import copy
 import numpy as np
+import queue
+import collections
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import src.utils as ut
 
 
@@ -62,7 +70,291 @@ def fitness_addittive_surjective_penalty(individual,matrices):
         if not ut.is_matrix_surjective(individualmatrix): penalty+=1    
     return penalty
 
-def fitness_jsd(individual,Aev,matrices,alpha_labels,metric=None, J=None,J_algorithm=None, verbose=False):
+def fitness_jsd(individual,Aev,matrices,alpha_labels,metric=None, J=None,J_algorithm=None, verbose=False, plan=None):
     new_alphas = convert_individual_vector_to_alphas(individual,matrices,alpha_labels)
-    Aev.A.alphas = new_alphas
-    return Aev.evaluate_cumulative_abstraction_errors(metric=metric, J=J,J_algorithm=J_algorithm, verbose=verbose)
\ No newline at end of file
+    if plan is not None:
+        return plan.score_cumulative(new_alphas,metric=metric,verbose=verbose)
+    # The alphas are passed to the evaluator instead of being assigned to the abstraction, so that individuals can be scored concurrently
+    return Aev.evaluate_cumulative_abstraction_errors(metric=metric, J=J,J_algorithm=J_algorithm, alphas=new_alphas, verbose=verbose)
+
+class GeneticAlgorithm():
+    """
+    Genetic algorithm learning the alphas of an abstraction by minimizing the cumulative abstraction error.
+
+    The population is stored as a single integer array [individuals x genes], where the genes of an individual are the concatenation
+    of the integer vectors encoding its alphas (see map_matrix2vect); selection, crossover and mutation act on the whole array at once,
+    and the distinct individuals of every generation are scored together with batched products (see AbstractionErrorPlan.score_batch).
+
+    Args:
+        Aev: an AbstractionErrorEvaluator
+        population_size: number of individuals in the population
+        mutation_rate: probability of mutating each gene
+        crossover_points: number of crossover points (chosen among the boundaries between alphas)
+        tournament_size: number of individuals competing in each tournament selection
+        n_elites: number of best individuals copied unchanged into the next generation
+        surjective_penalty: cost added for each non-surjective alpha in an individual
+        metric: distance used to compute the abstraction error
+        J: evaluation set (default: see AbstractionErrorEvaluator)
+        J_algorithm: algorithm to compute the evaluation set
+        seed: seed or numpy Generator for the random number generator
+        cache_size: maximum number of individuals whose cost is kept in the LRU fitness cache (0 disables caching)
+    """
+    def __init__(self,Aev,population_size=100,mutation_rate=0.1,crossover_points=1,tournament_size=2,n_elites=1,surjective_penalty=100,
+                 metric=None,J=None,J_algorithm=None,seed=None,cache_size=2**16):
+        self.Aev = Aev
+        self.population_size = population_size
+        self.mutation_rate = mutation_rate
+        self.crossover_points = crossover_points
+        self.tournament_size = tournament_size
+        self.n_elites = n_elites
+        self.surjective_penalty = surjective_penalty
+        self.metric = metric
+        self.rng = np.random.default_rng(seed)
+        
+        self.alpha_labels = list(Aev.A.M1.nodes)
+        self.matrices = [[Aev.A.get_cardinalities_alpha(x)[1],Aev.A.get_cardinalities_alpha(x)[0]] for x in self.alpha_labels]
+        self.offsets = np.cumsum([0]+[m[1] for m in self.matrices])
+        # Alpha to which each gene belongs, and number of values each gene may take
+        self.gene_alpha = np.repeat(np.arange(len(self.matrices)),[m[1] for m in self.matrices])
+        self.gene_high = np.repeat([m[0] for m in self.matrices],[m[1] for m in self.matrices])
+        
+        # The mechanisms do not depend on the alphas and are computed only once
+        self.plan = Aev.compile_plan(J=J,J_algorithm=J_algorithm)
+        
+        self.population = None
+        self.costs = None
+        self.history = []
+        
+        self.cache_size = cache_size
+        self.clear_cache()
+        
+    def __getstate__(self):
+        # The evaluator is not needed once the plan is compiled and is not shipped to worker processes
+        state = self.__dict__.copy()
+        state['Aev'] = None
+        state['cache'] = collections.OrderedDict()
+        del state['cache_lock']
+        return state
+    
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self.cache_lock = threading.Lock()
+        
+    def clear_cache(self):
+        self.cache_lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+        
+    def cache_info(self):
+        n_queries = self.cache_hits + self.cache_misses
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'evictions': self.cache_evictions,
+                'size': len(self.cache), 'maxsize': self.cache_size, 'hit_rate': self.cache_hits/n_queries if n_queries>0 else 0.0}
+        
+    def generate_random_population(self,size=None):
+        if size is None: size = self.population_size
+        return self.rng.integers(0,self.gene_high,size=(size,len(self.gene_high)))
+    
+    def get_alpha_vectors(self,individual):
+        return {x: individual[self.offsets[i]:self.offsets[i+1]] for i,x in enumerate(self.alpha_labels)}
+    
+    def get_alphas(self,individual):
+        return {x: ut.map_vect2matrix(v,self.matrices[i][0]) for i,(x,v) in enumerate(self.get_alpha_vectors(individual).items())}
+    
+    def count_non_surjective(self,population):
+        penalties = np.zeros(population.shape[0],dtype=int)
+        for i,(codom,_) in enumerate(self.matrices):
+            block = population[:,self.offsets[i]:self.offsets[i+1]]
+            is_surjective = (block[:,:,None]==np.arange(codom)).any(axis=1).all(axis=1)
+            penalties += ~is_surjective
+        return penalties
+    
+    def _score_batch(self,individuals):
+        alphas = {x: individuals[:,self.offsets[i]:self.offsets[i+1]] for i,x in enumerate(self.alpha_labels)}
+        return self.plan.score_batch(alphas,metric=self.metric,reduction='cumulative')
+    
+    def _compute_errors(self,individuals):
+        if self.cache_size == 0:
+            return self._score_batch(individuals)
+        
+        # Individuals are keyed by the canonical bytes of their concatenated alpha vectors
+        keys = [np.ascontiguousarray(ind,dtype=np.int64).tobytes() for ind in individuals]
+        errors = np.zeros(len(keys))
+        missing = []
+        with self.cache_lock:
+            for i,key in enumerate(keys):
+                if key in self.cache:
+                    self.cache_hits += 1
+                    self.cache.move_to_end(key)
+                    errors[i] = self.cache[key]
+                else:
+                    self.cache_misses += 1
+                    missing.append(i)
+        if len(missing) == 0: return errors
+        
+        # Individuals missing from the cache are scored in a single batch, outside the lock
+        errors[missing] = self._score_batch(individuals[missing])
+        with self.cache_lock:
+            for i in missing:
+                self.cache[keys[i]] = errors[i]
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                    self.cache_evictions += 1
+        return errors
+    
+    def evaluate(self,population):
+        # Every distinct individual is scored once per generation
+        unique,inverse = np.unique(population,axis=0,return_inverse=True)
+        errors = self._compute_errors(unique)
+        costs = errors + self.surjective_penalty*self.count_non_surjective(unique)
+        return costs[np.reshape(inverse,-1)]
+    
+    def select(self,costs,size):
+        contestants = self.rng.integers(0,len(costs),size=(size,self.tournament_size))
+        return contestants[np.arange(size),np.argmin(costs[contestants],axis=1)]
+    
+    def crossover(self,parents0,parents1):
+        n_alphas = len(self.matrices)
+        if n_alphas < 2 or self.crossover_points == 0: return parents0.copy()
+        # Genes are taken from the second parent after an odd number of crossover points
+        points = self.rng.integers(1,n_alphas,size=(parents0.shape[0],self.crossover_points))
+        mask = np.sum(self.gene_alpha[None,None,:] >= points[:,:,None],axis=1) % 2 == 1
+        return np.where(mask,parents1,parents0)
+    
+    def mutate(self,population):
+        mask = self.rng.random(population.shape) < self.mutation_rate
+        return np.where(mask,self.generate_random_population(population.shape[0]),population)
+    
+    def step(self):
+        if self.population is None:
+            self.population = self.generate_random_population()
+            self.costs = self.evaluate(self.population)
+            
+        n_offsprings = self.population_size - self.n_elites
+        parents0 = self.population[self.select(self.costs,n_offsprings)]
+        parents1 = self.population[self.select(self.costs,n_offsprings)]
+        offsprings = self.mutate(self.crossover(parents0,parents1))
+        
+        elites = np.argsort(self.costs,kind='stable')[:self.n_elites]
+        self.population = np.concatenate([self.population[elites],offsprings])
+        self.costs = np.concatenate([self.costs[elites],self.evaluate(offsprings)])
+        self.history.append(np.min(self.costs))
+        
+    def get_migrants(self,n_migrants):
+        best = np.argsort(self.costs,kind='stable')[:n_migrants]
+        return self.population[best].copy(),self.costs[best].copy()
+    
+    def receive_migrants(self,migrants,costs):
+        # Migrants replace the worst individuals of the population
+        worst = np.argsort(self.costs,kind='stable')[::-1][:len(costs)]
+        self.population[worst] = migrants
+        self.costs[worst] = costs
+        
+    def get_best(self):
+        best = np.argmin(self.costs)
+        return self.costs[best],self.get_alphas(self.population[best])
+    
+    def run(self,n_generations,tol=None,verbose=False):
+        """
+        Evolve the population for a number of generations.
+
+        Args:
+            n_generations: maximum number of generations
+            tol: if not None, stop as soon as the best cost is not greater than tol
+            verbose: print the best cost at every generation
+
+        Returns:
+            best_cost: the lowest cost in the population;
+            
+            best_alphas: dictionary of the alphas of the best individual
+        """
+        for generation in range(n_generations):
+            self.step()
+            if verbose: print('Generation {0}: best cost {1}'.format(generation,self.history[-1]))
+            if tol is not None and self.history[-1] <= tol: break
+        return self.get_best()
+
+
+def run_island_model(Aev,n_islands=4,n_generations=100,migration_interval=10,n_migrants=1,seed=None,n_jobs=-1,verbose=False,**kwargs):
+    """
+    Run independent genetic algorithms (islands) in separate processes, periodically sending the best individuals of each island
+    to the next one in a ring.
+
+    Every island draws its random numbers from an independent stream spawned from a single seed, and migrations are synchronous,
+    so a run is reproducible for a given seed independently of n_jobs.
+
+    Args:
+        Aev: an AbstractionErrorEvaluator
+        n_islands: number of populations
+        n_generations: number of generations evolved by every island
+        migration_interval: number of generations between two migrations
+        n_migrants: number of best individuals sent by every island at each migration
+        seed: seed of the random number generators
+        n_jobs: number of worker processes (-1: one per island, up to the number of CPUs; 1: islands evolve in the current process);
+            with fewer workers than islands, every worker evolves several islands in turn
+        verbose: print the best cost of every island after each migration
+        kwargs: parameters of GeneticAlgorithm
+
+    Returns:
+        best_cost: the lowest cost over all the islands;
+        
+        best_alphas: dictionary of the alphas of the best individual;
+        
+        histories: list of the best cost per generation of every island
+    """
+    streams = np.random.SeedSequence(seed).spawn(n_islands)
+    # The plan is compiled once and every island is a copy of the same driver with its own random stream
+    ga = GeneticAlgorithm(Aev,seed=streams[0],**kwargs)
+    
+    if n_jobs is None or n_jobs < 0: n_jobs = os.cpu_count()
+    n_jobs = max(1,min(n_jobs,n_islands))
+    # Islands are distributed among the workers, each one evolving its islands in turn between two migrations
+    groups = [list(range(i,n_islands,n_jobs)) for i in range(n_jobs)]
+    
+    if n_jobs == 1:
+        queues = [queue.Queue() for _ in range(n_islands)]
+        results = _run_islands(ga,streams,groups[0],queues,threading.Event(),n_generations,migration_interval,n_migrants,verbose)
+    else:
+        with multiprocessing.Manager() as manager:
+            queues = [manager.Queue() for _ in range(n_islands)]
+            # A failing worker sets the abort event, so that the workers waiting for its migrants stop instead of blocking forever
+            abort = manager.Event()
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(_run_islands,ga,streams,group,queues,abort,n_generations,migration_interval,n_migrants,verbose) for group in groups]
+                # The first failure is raised (the other workers then abort)
+                results = {}
+                for future in as_completed(futures):
+                    results.update(future.result())
+    
+    results = [results[i] for i in range(n_islands)]
+    best = int(np.argmin([r[0] for r in results]))
+    return results[best][0],ga.get_alphas(results[best][1]),[r[2] for r in results]
+
+def _run_islands(ga,streams,islands,queues,abort,n_generations,migration_interval,n_migrants,verbose,poll_interval=1.0):
+    try:
+        gas = {i: copy.deepcopy(ga) for i in islands}
+        for i in islands: gas[i].rng = np.random.default_rng(streams[i])
+        
+        for start in range(0,n_generations,migration_interval):
+            for i in islands:
+                for _ in range(start,min(start+migration_interval,n_generations)): gas[i].step()
+            if start+migration_interval < n_generations:
+                # Send the best individuals to the next island, then wait for those of the previous one
+                for i in islands:
+                    queues[(i+1) % len(queues)].put(gas[i].get_migrants(n_migrants))
+                for i in islands:
+                    gas[i].receive_migrants(*_get_migrants(queues[i],abort,poll_interval))
+            if verbose:
+                for i in islands: print('Island {0}, generation {1}: best cost {2}'.format(i,min(start+migration_interval,n_generations),gas[i].history[-1]))
+    except BaseException:
+        abort.set()
+        raise
+    return {i: (np.min(gas[i].costs),gas[i].population[np.argmin(gas[i].costs)],gas[i].history) for i in islands}
+
+def _get_migrants(q,abort,poll_interval):
+    while True:
+        try:
+            return q.get(timeout=poll_interval)
+        except queue.Empty:
+            if abort.is_set(): raise RuntimeError("Island model aborted after a failure in another worker")
@@ -1,31 +1,90 @@
 
+import os
+import json
+import hashlib
+import heapq
 import numpy as np
 import itertools
+import math
+import torch
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import src.utils as ut
-from src.SCMMappings_1_1 import Abstraction
 from src.evaluating import AbstractionErrorEvaluator
+from src.automating import RelaxedAbstractionError
 
 
-def enumerate_all_surjective_maps(dom,codom):
-    diff = dom-codom
+def count_surjective_maps(dom,codom):
+    # Number of surjections, i.e. codom! times the number of partitions of dom elements into codom blocks
+    return math.factorial(codom) * _count_rgs_completions(dom,codom)[0][0] if 0<codom<=dom else 0
+
+def _count_rgs_completions(dom,codom):
+    # N[i][m]: number of restricted-growth strings completing positions i..dom-1 with exactly codom blocks, given the largest value m so far
+    N = [[0]*(codom+1) for _ in range(dom+1)]
+    N[dom][codom-1] = 1
+    for i in range(dom-1,0,-1):
+        for m in range(codom):
+            N[i][m] = (m+1)*N[i+1][m] + (N[i+1][m+1] if m+1<codom else 0)
+    N[0][0] = N[1][0]
+    return N
+
+def unrank_surjective_map(rank,dom,codom,N=None):
+    # A surjection is encoded as a restricted-growth string (a partition of the domain into codom blocks) and a labelling of the blocks
+    if N is None: N = _count_rgs_completions(dom,codom)
+    rgs_rank,perm_rank = divmod(rank,math.factorial(codom))
     
-    surjective_values = np.arange(0,codom,dtype=int)
-    nonsurjective_values = np.array(list(itertools.product(surjective_values,repeat=diff)),dtype=int)
+    rgs = [0]; m = 0
+    for i in range(1,dom):
+        if rgs_rank < (m+1)*N[i+1][m]:
+            v,rgs_rank = divmod(rgs_rank,N[i+1][m])
+        else:
+            v = m+1; rgs_rank -= (m+1)*N[i+1][m]
+        rgs.append(v); m = max(m,v)
+
+    labels = list(range(codom)); perm = []
+    for k in range(codom,0,-1):
+        idx,perm_rank = divmod(perm_rank,math.factorial(k-1))
+        perm.append(labels.pop(idx))
+        
+    return np.array(perm,dtype=int)[rgs]
+
+def rank_surjective_map(v,codom,N=None):
+    v = list(v); dom = len(v)
+    if N is None: N = _count_rgs_completions(dom,codom)
+    
+    # Blocks are numbered by first occurrence, which gives the restricted-growth string and the labelling of the blocks
+    perm = list(dict.fromkeys(v))
+    block = {x:i for i,x in enumerate(perm)}
+    rgs_rank = 0; m = 0
+    for i in range(1,dom):
+        b = block[v[i]]
+        rgs_rank += b*N[i+1][m] if b<=m else (m+1)*N[i+1][m]
+        m = max(m,b)
     
-    surjective_maps = []
-    for nsv in nonsurjective_values:
-        map_values = np.concatenate((surjective_values,nsv))
-        surjective_maps.extend(list(itertools.permutations(np.concatenate((surjective_values,nsv)))))
+    labels = list(range(codom)); perm_rank = 0
+    for k,x in zip(range(codom,0,-1),perm):
+        perm_rank += labels.index(x)*math.factorial(k-1)
+        labels.remove(x)
         
-    return list(set(surjective_maps))
+    return rgs_rank*math.factorial(codom) + perm_rank
+
+def iter_surjective_maps(dom,codom,start=0,stop=None):
+    # Stream the surjective maps with rank in [start,stop), each one exactly once
+    N = _count_rgs_completions(dom,codom) if 0<codom<=dom else None
+    n_maps = count_surjective_maps(dom,codom)
+    if stop is None or stop > n_maps: stop = n_maps
+    for rank in range(start,stop):
+        yield unrank_surjective_map(rank,dom,codom,N=N)
+
+def enumerate_all_surjective_maps(dom,codom):
+    return list(iter_surjective_maps(dom,codom))
+
+def iter_surjective_matrices(dom,codom,start=0,stop=None):
+    for v in iter_surjective_maps(dom,codom,start=start,stop=stop):
+        yield ut.map_vect2matrix(v,codom)
 
-def get_all_surjective_matrices(dom,codom):
-    vs = enumerate_all_surjective_maps(dom,codom)
-    Ms = []
-    for v in vs:
-        Ms.append(ut.map_vect2matrix(v))
-    return Ms
+def get_all_surjective_matrices(dom,codom,start=0,stop=None):
+    return list(iter_surjective_matrices(dom,codom,start=start,stop=stop))
 
 def learn_alpha_by_enumeration(A,J=None):
     alphanames = list(A.M1.nodes)
@@ -35,16 +94,172 @@ def learn_alpha_by_enumeration(A,J=None):
         candidates = get_all_surjective_matrices(dom,codom)
         candidate_alphas[X_] = candidates
     
-    c_alphas=[]
-    c_errors=[]
-    for c_alpha in itertools.product(*candidate_alphas.values()):
-        alphas = {}
-        for i in range(len(alphanames)):
-            alphas[alphanames[i]] = c_alpha[i]
-        c_A = Abstraction(A.M0,A.M1,A.R,A.a,alphas)
-        c_A_ev = AbstractionErrorEvaluator(c_A)
-
-        c_errors.append(c_A_ev.evaluate_overall_abstraction_error(J=J))
-        c_alphas.append(alphas)
+    # The mechanisms do not depend on the alphas and are computed only once
+    plan = AbstractionErrorEvaluator(A).compile_plan(J=J)
+    
+    # Branch and bound: alphas are assigned one variable at a time, and every pair is scored as soon as the alphas of its sources and targets are assigned
+    order = _get_assignment_order(alphanames,plan.J)
+    pairs_at_level = _get_pairs_at_level(order,plan.J)
+    
+    best = {'error': None, 'indexes': None, 'alphas': None}
+    
+    def search(level,alphas,indexes,partial_error):
+        if level == len(order):
+            # Ties are broken as in the exhaustive search, by the position of the candidate in the Cartesian product
+            c_indexes = tuple(indexes[X_] for X_ in alphanames)
+            if best['error'] is None or partial_error < best['error'] or (partial_error == best['error'] and c_indexes < best['indexes']):
+                best['error'] = partial_error; best['indexes'] = c_indexes; best['alphas'] = dict(alphas)
+            return
         
-    return np.min(c_errors),c_alphas[np.argmin(c_errors)]
\ No newline at end of file
+        X_ = order[level]
+        for i,candidate in enumerate(candidate_alphas[X_]):
+            alphas[X_] = candidate; indexes[X_] = i
+            error = partial_error
+            for k in pairs_at_level[level]:
+                error = max(error,plan.score_pair(k,alphas))
+                # The error can only grow along a branch, which is pruned as soon as it is worse than the incumbent
+                if best['error'] is not None and error > best['error']: break
+            if best['error'] is not None and error > best['error']: continue
+            search(level+1,alphas,indexes,error)
+        del alphas[X_]; del indexes[X_]
+        
+    search(0,{},{},0.0)
+    
+    return best['error'],{X_: best['alphas'][X_] for X_ in alphanames}
+
+def _get_assignment_order(alphanames,J):
+    # Greedily assign first the variable that determines the most pairs, so that bounds become available early
+    order = []
+    remaining = list(alphanames)
+    while remaining:
+        assigned = set(order)
+        n_determined = [sum(1 for S,T in J if set(S+T) <= assigned|{X_}) for X_ in remaining]
+        X_ = remaining[int(np.argmax(n_determined))]
+        order.append(X_); remaining.remove(X_)
+    return order
+
+def _get_pairs_at_level(order,J):
+    # Index of the pairs determined by the assignment of each variable in the order
+    pairs_at_level = [[] for _ in order]
+    for k,(S,T) in enumerate(J):
+        pairs_at_level[max(order.index(X_) for X_ in S+T)].append(k)
+    return pairs_at_level
+
+def learn_alpha_by_sharded_enumeration(A,J=None,top_k=1,n_jobs=-1,n_shards=None,checkpoint=None,metric=None):
+    # The Cartesian product of the candidate alphas is ranked (last variable varying fastest, as in itertools.product) and
+    # split into rank ranges scored across a process pool; every shard keeps only its running top-k
+    alphanames = list(A.M1.nodes)
+    n_candidates = [count_surjective_maps(*A.get_cardinalities_alpha(X_)) for X_ in alphanames]
+    size = int(np.prod(n_candidates,dtype=object))
+    
+    if n_jobs is None or n_jobs < 0: n_jobs = os.cpu_count()
+    if n_shards is None: n_shards = 4*n_jobs
+    n_shards = max(1,min(n_shards,size))
+    bounds = [size*i//n_shards for i in range(n_shards+1)]
+    
+    plan = AbstractionErrorEvaluator(A).compile_plan(J=J)
+    specs = [A.get_cardinalities_alpha(X_) for X_ in alphanames]
+    
+    # Completed shards are recorded in the checkpoint file, so that an interrupted run resumes from the remaining shards;
+    # the checkpoint is identified by a fingerprint of the alphas, of the evaluation set and mechanisms, and of the metric
+    fingerprint = _get_enumeration_fingerprint(plan,alphanames,specs,metric)
+    results = _load_checkpoint(checkpoint,fingerprint,size,n_shards,top_k)
+    pending = [i for i in range(n_shards) if i not in results]
+    
+    if n_jobs == 1:
+        _init_enumeration_worker(plan,alphanames,specs,metric)
+        for i in pending:
+            results[i] = _score_shard(bounds[i],bounds[i+1],top_k)
+            _save_checkpoint(checkpoint,fingerprint,size,n_shards,top_k,results)
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs,initializer=_init_enumeration_worker,initargs=(plan,alphanames,specs,metric)) as executor:
+            futures = {executor.submit(_score_shard,bounds[i],bounds[i+1],top_k): i for i in pending}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                _save_checkpoint(checkpoint,fingerprint,size,n_shards,top_k,results)
+    
+    # Candidates are sorted by error, and ties by rank, as in the exhaustive search
+    best = heapq.nsmallest(top_k,itertools.chain.from_iterable(results.values()))
+    candidates = [get_all_surjective_matrices(*spec) for spec in specs]
+    return [(error,_unrank_candidate(rank,alphanames,candidates)) for error,rank in best]
+
+def learn_alpha_by_relaxation(A,J=None,n_epochs=500,lr=0.1,temperatures=(1.0,0.01),surjective_penalty=1.0,metric='jsd',reduction='cumulative',seed=None,verbose=False):
+    # Gradient descent on softmax-relaxed alphas, for alpha domains too large to enumerate; the temperature is annealed geometrically
+    # so that the relaxed alphas approach deterministic maps, which are finally snapped onto surjections and scored exactly
+    plan = AbstractionErrorEvaluator(A).compile_plan(J=J)
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+    model = RelaxedAbstractionError.from_plan(plan,A.M0,A.M1,A.a,metric=metric,reduction=reduction,generator=generator)
+    optimizer = torch.optim.Adam(model.parameters(),lr=lr)
+    
+    T0,T1 = temperatures
+    for epoch in range(n_epochs):
+        temperature = T0 * (T1/T0)**(epoch/max(n_epochs-1,1))
+        optimizer.zero_grad()
+        loss = model(temperature) + surjective_penalty*model.surjectivity_penalty(temperature)
+        loss.backward()
+        optimizer.step()
+        if verbose and epoch % 100 == 0: print('Epoch {0}: loss {1} (temperature {2})'.format(epoch,loss.item(),temperature))
+    
+    alphas = model.get_alphas()
+    alphas = {X_: alphas[X_] for X_ in A.M1.nodes}
+    return plan.score_overall(alphas,metric=metric),alphas
+
+_enumeration_state = {}
+
+def _init_enumeration_worker(plan,alphanames,specs,metric=None):
+    _enumeration_state['plan'] = plan
+    _enumeration_state['metric'] = metric
+    _enumeration_state['alphanames'] = alphanames
+    _enumeration_state['candidates'] = [get_all_surjective_matrices(dom,codom) for dom,codom in specs]
+    
+def _unrank_candidate(rank,alphanames,candidates):
+    alphas = {}
+    for X_,c in zip(reversed(alphanames),reversed(candidates)):
+        rank,idx = divmod(rank,len(c))
+        alphas[X_] = c[idx]
+    return {X_: alphas[X_] for X_ in alphanames}
+
+def _score_shard(start,stop,top_k):
+    plan = _enumeration_state['plan']
+    alphanames = _enumeration_state['alphanames']
+    candidates = _enumeration_state['candidates']
+    
+    # Max-heap (by negated error and rank) of the best top_k candidates in the shard
+    heap = []
+    for rank in range(start,stop):
+        alphas = _unrank_candidate(rank,alphanames,candidates)
+        bound = -heap[0][0] if len(heap)==top_k else None
+        error = float(plan.score_overall(alphas,metric=_enumeration_state['metric'],stop_above=bound))
+        if bound is None:
+            heapq.heappush(heap,(-error,-rank))
+        elif error < bound:
+            heapq.heapreplace(heap,(-error,-rank))
+    return [(-e,-r) for e,r in heap]
+
+def _get_enumeration_fingerprint(plan,alphanames,specs,metric):
+    if metric is None or isinstance(metric,str):
+        metric_name = str(metric)
+    else:
+        metric_name = '{0}.{1}'.format(getattr(metric,'__module__',''),getattr(metric,'__qualname__',repr(metric)))
+    h = hashlib.sha256(json.dumps([[str(X_) for X_ in alphanames],[[int(x) for x in spec] for spec in specs],
+                                   [[[str(x) for x in S],[str(x) for x in T]] for S,T in plan.J],metric_name]).encode())
+    for M0_cond_TS_val,M1_cond_TS_val in plan.mechanisms:
+        h.update(np.ascontiguousarray(M0_cond_TS_val,dtype=np.float64).tobytes())
+        h.update(np.ascontiguousarray(M1_cond_TS_val,dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+def _load_checkpoint(checkpoint,fingerprint,size,n_shards,top_k):
+    if checkpoint is None or not os.path.exists(checkpoint): return {}
+    with open(checkpoint) as f:
+        state = json.load(f)
+    if state.get('fingerprint') != fingerprint or state['size'] != size or state['n_shards'] != n_shards or state['top_k'] != top_k:
+        raise ValueError("Checkpoint {0} was created for a different enumeration".format(checkpoint))
+    return {int(i): [tuple(x) for x in v] for i,v in state['shards'].items()}
+
+def _save_checkpoint(checkpoint,fingerprint,size,n_shards,top_k,results):
+    if checkpoint is None: return
+    state = {'fingerprint': fingerprint, 'size': size, 'n_shards': n_shards, 'top_k': top_k, 'shards': {str(i): v for i,v in results.items()}}
+    # Write to a temporary file first, so that a run killed while saving does not corrupt the checkpoint
+    with open(checkpoint+'.tmp','w') as f:
+        json.dump(state,f)
+    os.replace(checkpoint+'.tmp',checkpoint)
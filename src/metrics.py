@@ -0,0 +1,145 @@
+import numpy as np
+
+from scipy import stats
+from scipy.special import rel_entr
+from scipy.spatial import distance
+
+
+def _normalize(P):
+    with np.errstate(divide='ignore',invalid='ignore'):
+        return P / np.sum(P,axis=0,keepdims=True)
+
+def jensenshannon(P,Q):
+    """
+    Compute the Jensen-Shannon distance (natural base) between the columns of two matrices.
+
+    Args:
+        P: numpy array of distributions along the first axis
+        Q: numpy array of distributions along the first axis
+
+    Returns:
+        Numpy array of distances, with the shape of P without its first axis
+
+    Example:
+        P.shape = (4,10);
+        Q.shape = (4,10);
+        res.shape = (10,).
+    """
+    P = _normalize(P); Q = _normalize(Q)
+    M = (P+Q) / 2.0
+    js = np.sum(rel_entr(P,M),axis=0) + np.sum(rel_entr(Q,M),axis=0)
+    # Clip negative values due to round-off before taking the square root
+    return np.sqrt(np.maximum(js,0) / 2.0)
+
+def kullback_leibler(P,Q):
+    """
+    Compute the Kullback-Leibler divergence KL(P||Q) (natural base) between the columns of two matrices.
+
+    Args:
+        P: numpy array of distributions along the first axis
+        Q: numpy array of distributions along the first axis
+
+    Returns:
+        Numpy array of divergences, with the shape of P without its first axis
+    """
+    P = _normalize(P); Q = _normalize(Q)
+    return np.sum(rel_entr(P,Q),axis=0)
+
+def total_variation(P,Q):
+    """
+    Compute the total variation distance between the columns of two matrices.
+
+    Args:
+        P: numpy array of distributions along the first axis
+        Q: numpy array of distributions along the first axis
+
+    Returns:
+        Numpy array of distances, with the shape of P without its first axis
+    """
+    P = _normalize(P); Q = _normalize(Q)
+    return np.sum(np.abs(P-Q),axis=0) / 2.0
+
+def hellinger(P,Q):
+    """
+    Compute the Hellinger distance between the columns of two matrices.
+
+    Args:
+        P: numpy array of distributions along the first axis
+        Q: numpy array of distributions along the first axis
+
+    Returns:
+        Numpy array of distances, with the shape of P without its first axis
+    """
+    P = _normalize(P); Q = _normalize(Q)
+    h = np.sum((np.sqrt(P)-np.sqrt(Q))**2,axis=0) / 2.0
+    return np.sqrt(np.maximum(h,0))
+
+def wasserstein(P,Q):
+    """
+    Compute the Wasserstein-1 distance between the columns of two matrices, assuming the support is ordered and unit-spaced.
+
+    Args:
+        P: numpy array of distributions along the first axis
+        Q: numpy array of distributions along the first axis
+
+    Returns:
+        Numpy array of distances, with the shape of P without its first axis
+    """
+    P = _normalize(P); Q = _normalize(Q)
+    return np.sum(np.abs(np.cumsum(P,axis=0)-np.cumsum(Q,axis=0)),axis=0)
+
+
+METRICS = {'jsd': jensenshannon,
+           'kl': kullback_leibler,
+           'tv': total_variation,
+           'hellinger': hellinger,
+           'wasserstein': wasserstein}
+
+# Scalar functions with an equivalent vectorized kernel
+ALIASES = {distance.jensenshannon: jensenshannon,
+           stats.entropy: kullback_leibler}
+
+def register_metric(name,kernel):
+    """
+    Register a vectorized kernel, i.e. a function taking two arrays of distributions along the first axis and returning the array of distances.
+    """
+    METRICS[name] = kernel
+
+def get_vectorized_metric(metric=None):
+    """
+    Retrieve the vectorized kernel associated with a metric.
+
+    Args:
+        metric: None (default: Jensen-Shannon distance), the name of a registered metric, or a callable
+
+    Returns:
+        The vectorized kernel, or None if the metric is a custom callable without a vectorized equivalent
+    """
+    if metric is None:
+        return jensenshannon
+    if isinstance(metric,str):
+        if metric not in METRICS: raise ValueError("Unknown metric {0}".format(metric))
+        return METRICS[metric]
+    if metric in ALIASES:
+        return ALIASES[metric]
+    if metric in METRICS.values():
+        return metric
+    return None
+
+def compute_distances(P,Q,metric=None):
+    """
+    Compute the distances between the columns of two 2D matrices.
+
+    Args:
+        P: 2D numpy array of distributions along the columns
+        Q: 2D numpy array of distributions along the columns
+        metric: None, the name of a registered metric, or a callable taking two 1D distributions; custom callables
+            without a vectorized kernel are evaluated column by column
+
+    Returns:
+        1D numpy array of distances, one for each column
+    """
+    kernel = get_vectorized_metric(metric)
+    if kernel is not None:
+        return kernel(P,Q)
+    return np.array([metric(P[:,c],Q[:,c]) for c in range(P.shape[1])])
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+import src.utils as ut
+
+
+class GlobalAlphaOperator(LinearOperator):
+    """
+    Lazy linear operator encoding the global alpha of an abstraction, that is the tensor product of the alphas of all
+    the nodes in M1, tiled once for every configuration of the nodes of M0 not in R.
+
+    The operator supports products with vectors and matrices (and with their transposes) without materializing
+    the global alpha, whose size is the product of the cardinalities of M1 times the product of the cardinalities of M0.
+
+    Args:
+        alphas: list of alphas ordered as the nodes of M1, each one either a matrix or an integer vector (see map_matrix2vect)
+        rows: list of the cardinalities of the nodes of M1 (required for alphas encoded as vectors)
+        n_tiles: number of configurations of the nodes of M0 not in R
+    """
+    def __init__(self,alphas,rows=None,n_tiles=1):
+        if rows is None: rows = [x.shape[0] for x in alphas]
+        self.rows = list(rows)
+        self.n_tiles = int(n_tiles)
+
+        if all(np.ndim(x)==1 for x in alphas):
+            self.alpha_vector = ut.kron_index(alphas,self.rows)
+            self.alphas = None
+            n_cols = len(self.alpha_vector)
+        else:
+            self.alpha_vector = None
+            self.alphas = [x if np.ndim(x)==2 else ut.map_vect2matrix(x,r) for x,r in zip(alphas,self.rows)]
+            n_cols = int(np.prod([x.shape[1] for x in self.alphas]))
+
+        self.n_rows = int(np.prod(self.rows))
+        self.n_cols = n_cols
+        super().__init__(dtype=np.float64,shape=(self.n_rows,self.n_tiles*self.n_cols))
+
+    def _kron_matmat(self,X):
+        if self.alpha_vector is not None:
+            return ut.aggregate_rows(self.alpha_vector,X,self.n_rows)
+        return ut.kron_dot(self.alphas,X)
+
+    def _kron_rmatmat(self,Y):
+        if self.alpha_vector is not None:
+            return Y[self.alpha_vector,:]
+        return ut.dot_kron(Y.T,self.alphas).T
+
+    def _matmat(self,X):
+        X = np.asarray(X,dtype=np.float64)
+        # Tiled columns contribute identically: sum the blocks before applying the tensor product
+        X = X.reshape((self.n_tiles,self.n_cols,X.shape[1])).sum(axis=0)
+        return self._kron_matmat(X)
+
+    def _rmatmat(self,Y):
+        Y = np.asarray(Y,dtype=np.float64)
+        return np.tile(self._kron_rmatmat(Y),(self.n_tiles,1))
+
+    def _matvec(self,x):
+        return self._matmat(np.reshape(x,(-1,1))).ravel()
+
+    def _rmatvec(self,y):
+        return self._rmatmat(np.reshape(y,(-1,1))).ravel()
+
+    def row_sums(self):
+        """
+        Compute the sums of the rows of the global alpha.
+        """
+        if self.alpha_vector is not None:
+            sums = np.bincount(self.alpha_vector,minlength=self.n_rows).astype(np.float64)
+        else:
+            sums = np.ones(1)
+            for x in self.alphas:
+                sums = np.kron(sums,np.sum(x,axis=1))
+        return self.n_tiles * sums
+
+    def invert_max_entropy(self):
+        """
+        Lazy equivalent of utils.invert_matrix_max_entropy applied to the global alpha.
+        """
+        sums = self.row_sums()
+        def matmat(Y):
+            Y = np.asarray(Y,dtype=np.float64).reshape((self.shape[0],-1))
+            return self._rmatmat(Y / sums[:,None])
+        def rmatmat(X):
+            X = np.asarray(X,dtype=np.float64).reshape((self.shape[1],-1))
+            return self._matmat(X) / sums[:,None]
+        return LinearOperator(dtype=np.float64,shape=(self.shape[1],self.shape[0]),
+                              matvec=lambda y: matmat(y).ravel(),rmatvec=lambda x: rmatmat(x).ravel(),
+                              matmat=matmat,rmatmat=rmatmat)
+
+    def invert_pinv(self):
+        """
+        Lazy equivalent of utils.invert_matrix_pinv applied to the global alpha, based on the identities
+        pinv(A x B) = pinv(A) x pinv(B) and pinv([K ... K]) = [pinv(K); ...; pinv(K)] / n_tiles.
+        """
+        if self.alpha_vector is not None:
+            # For a binary matrix with one non-zero per column the pseudo-inverse coincides with the max entropy inverse
+            return self.invert_max_entropy()
+
+        pinvs = [np.linalg.pinv(x) for x in self.alphas]
+        def matmat(Y):
+            Y = np.asarray(Y,dtype=np.float64).reshape((self.shape[0],-1))
+            return np.tile(ut.kron_dot(pinvs,Y),(self.n_tiles,1)) / self.n_tiles
+        def rmatmat(X):
+            X = np.asarray(X,dtype=np.float64).reshape((self.shape[1],-1))
+            X = X.reshape((self.n_tiles,self.n_cols,X.shape[1])).sum(axis=0)
+            return ut.kron_dot([p.T for p in pinvs],X) / self.n_tiles
+        return LinearOperator(dtype=np.float64,shape=(self.shape[1],self.shape[0]),
+                              matvec=lambda y: matmat(y).ravel(),rmatvec=lambda x: rmatmat(x).ravel(),
+                              matmat=matmat,rmatmat=rmatmat)
@@ -0,0 +1,55 @@
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def share_arrays(arrays):
+    """
+    Copy a dictionary of numpy arrays into a single block of shared memory.
+
+    Args:
+        arrays: dictionary of numpy arrays
+
+    Returns:
+        shm: the SharedMemory block, to be closed and unlinked by the caller when no longer needed;
+        
+        specs: dictionary mapping each key to the tuple (offset, shape, dtype) of its array in the block
+        
+    Example:
+        arrays = {'x': np.ones((2,3)), 'y': np.arange(4)};
+        shm,specs = share_arrays(arrays);
+        _,views = attach_arrays(shm.name,specs);
+        views['x'].shape = (2,3).
+    """
+    specs = {}
+    offset = 0
+    for k,x in arrays.items():
+        x = np.asarray(x)
+        # Align every array on 8 bytes
+        offset = (offset+7)//8*8
+        specs[k] = (offset, x.shape, x.dtype.str)
+        offset += x.nbytes
+
+    shm = shared_memory.SharedMemory(create=True,size=max(offset,1))
+    for k,x in arrays.items():
+        _get_view(shm,specs[k])[...] = x
+    return shm,specs
+
+def attach_arrays(name,specs):
+    """
+    Attach to a block of shared memory created by share_arrays and expose its arrays without copying them.
+
+    Args:
+        name: name of the SharedMemory block
+        specs: dictionary of array specifications returned by share_arrays
+
+    Returns:
+        shm: the SharedMemory block, which must be kept alive as long as the arrays are in use;
+        
+        arrays: dictionary of numpy arrays backed by the shared memory
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, {k: _get_view(shm,spec) for k,spec in specs.items()}
+
+def _get_view(shm,spec):
+    offset,shape,dtype = spec
+    return np.ndarray(shape,dtype=np.dtype(dtype),buffer=shm.buf,offset=offset)
@@ -175,6 +175,156 @@ def tensorize_list(tensor,l):
         else:
             return tensor
 
+def kron_dot(l,M):
+    """
+    Compute the product between the tensor product of a list of 2D matrices and a 2D matrix, without materializing the tensor product
+
+    Args:
+        l: list of 2D numpy arrays
+        M: 2D numpy array
+
+    Returns:
+        2D numpy array equal to np.dot(tensorize_list(None,l),M)
+
+    Example:
+        l = [x,y];
+            x.shape = (3,7);
+            y.shape = (5,4);
+        M.shape = (28,6);
+        res.shape = (15,6).
+    """
+    if len(l)==1:
+        return np.dot(l[0],M)
+
+    # Reshape the rows of M as a tensor and contract each axis with the corresponding matrix (mode-n product)
+    T = M.reshape([x.shape[1] for x in l]+[M.shape[1]])
+    for i in range(len(l)):
+        T = np.moveaxis(np.tensordot(l[i],T,axes=([1],[i])),0,i)
+    return T.reshape((np.prod([x.shape[0] for x in l]),M.shape[1]))
+
+def dot_kron(M,l):
+    """
+    Compute the product between a 2D matrix and the tensor product of a list of 2D matrices, without materializing the tensor product
+
+    Args:
+        M: 2D numpy array
+        l: list of 2D numpy arrays
+
+    Returns:
+        2D numpy array equal to np.dot(M,tensorize_list(None,l))
+
+    Example:
+        M.shape = (6,15);
+        l = [x,y];
+            x.shape = (3,7);
+            y.shape = (5,4);
+        res.shape = (6,28).
+    """
+    if len(l)==1:
+        return np.dot(M,l[0])
+
+    # Reshape the columns of M as a tensor and contract each axis with the corresponding matrix (mode-n product)
+    T = M.reshape([M.shape[0]]+[x.shape[0] for x in l])
+    for i in range(len(l)):
+        T = np.moveaxis(np.tensordot(T,l[i],axes=([i+1],[0])),-1,i+1)
+    return T.reshape((M.shape[0],np.prod([x.shape[1] for x in l])))
+
+def kron_index(l,rows):
+    """
+    Compute the integer vector encoding the tensor product of a list of binary matrices encoded as integer vectors
+
+    Args:
+        l: list of integer vectors
+        rows: list of integers denoting the number of rows of each binary matrix
+
+    Returns:
+        Integer vector v such that map_vect2matrix(v) is the tensor product of the binary matrices
+
+    Example:
+        l = [[1,0],[0,1,1]];
+        rows = [2,2];
+        res = [2,3,3,0,1,1].
+    """
+    if len(l)==1:
+        return np.asarray(l[0])
+    grid = np.meshgrid(*l,indexing='ij')
+    return np.ravel_multi_index(grid,rows).ravel()
+
+def aggregate_rows(v,M,rows):
+    """
+    Compute the product between a binary matrix encoded as an integer vector and a 2D matrix, by summing the rows of M mapped to the same value
+
+    Args:
+        v: integer vector
+        M: 2D numpy array
+        rows: integer denoting the number of rows of the binary matrix
+
+    Returns:
+        2D numpy array equal to np.dot(map_vect2matrix(v,rows),M)
+
+    Example:
+        v = [1,0,1];
+        M = [[1,2],
+             [3,4],
+             [5,6]];
+        rows = 2;
+        res = [[3,4],
+               [6,8]].
+    """
+    ncols = M.shape[1]
+    idxs = (np.asarray(v)[:,None]*ncols + np.arange(ncols)).ravel()
+    res = np.bincount(idxs,weights=M.ravel(),minlength=rows*ncols)
+    return res.reshape((rows,ncols))
+
+def gather_columns(M,v):
+    """
+    Compute the product between a 2D matrix and a binary matrix encoded as an integer vector, by selecting the columns of M
+
+    Args:
+        M: 2D numpy array
+        v: integer vector
+
+    Returns:
+        2D numpy array equal to np.dot(M,map_vect2matrix(v,M.shape[1]))
+
+    Example:
+        M = [[1,2],
+             [3,4]];
+        v = [1,0,1];
+        res = [[2,1,2],
+               [4,3,4]].
+    """
+    return M[:,v]
+
+def marginalize_mechanism(M,targets,subtargets,cardinalities):
+    """
+    Compute the mechanism P(subtargets|sources) from the mechanism P(targets|sources) by summing out the targets not in subtargets
+
+    Args:
+        M: 2D numpy array [targets x sources], with rows ordered as the joint values of targets
+        targets: list of target nodes
+        subtargets: list of target nodes contained in targets, in the desired order
+        cardinalities: dictionary of node cardinalities
+
+    Returns:
+        2D numpy array [subtargets x sources]
+        
+    Example:
+        targets = ['A','B'];
+        subtargets = ['B'];
+        cardinalities = {'A': 2, 'B': 3};
+        M.shape = (6,4);
+        res.shape = (3,4).
+    """
+    if list(subtargets) == list(targets):
+        return M
+    
+    T = M.reshape([cardinalities[t] for t in targets]+[M.shape[1]])
+    T = np.sum(T,axis=tuple(i for i,t in enumerate(targets) if t not in subtargets))
+    remaining = [t for t in targets if t in subtargets]
+    T = np.transpose(T,[remaining.index(t) for t in subtargets]+[len(remaining)])
+    return T.reshape((int(np.prod([cardinalities[t] for t in subtargets])),M.shape[1]))
+
 def invert_matrix_max_entropy(A):
     """
     Compute the inverse of matrix A by transposting and normalizing the column